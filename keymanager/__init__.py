@@ -1,7 +1,67 @@
-from Crypto.Cipher import AES
+import importlib
 
+# 包本身只定义格式常量，不导入pycryptodome和PySide6。
+# 常用的类和函数在第一次访问时才导入对应的模块，只用到核心功能的进程不会加载Qt
+
+# 与Crypto.Cipher.AES.block_size相同，这里不导入pycryptodome
+_AES_BLOCK_SIZE = 16
 
 _HEAD_MARKER = b'AES-V-0000000001'
 _HEAD_MARKER_BYTE_SIZE = 16
 _HEAD_FILE_SIZE_BYTE_SIZE = 128
-_HEAD_LENGTH = _HEAD_MARKER_BYTE_SIZE + _HEAD_FILE_SIZE_BYTE_SIZE + AES.block_size
+_HEAD_LENGTH = _HEAD_MARKER_BYTE_SIZE + _HEAD_FILE_SIZE_BYTE_SIZE + _AES_BLOCK_SIZE
+
+# v2：分块加密，带块索引，可以随机读取
+_HEAD_MARKER_V2 = b'AES-V-0000000002'
+_CHUNK_SIZE_BYTE_SIZE = 4
+_CHUNK_FLAGS_BYTE_SIZE = 4
+_CHUNK_NONCE_BYTE_SIZE = 8
+_CHUNK_INDEX_ENTRY_SIZE = 8
+# v3：分块格式，每块使用AES-GCM加密并附带校验标签
+_HEAD_MARKER_V3 = b'AES-V-0000000003'
+_CHUNK_TAG_BYTE_SIZE = 16
+# v3的流式变体：不写明文长度和索引，每块前面是4字节的密文长度
+_FRAME_LENGTH_BYTE_SIZE = 4
+
+_CHUNKED_HEAD_LENGTH = _HEAD_MARKER_BYTE_SIZE + _HEAD_FILE_SIZE_BYTE_SIZE + _CHUNK_SIZE_BYTE_SIZE + \
+                       _CHUNK_FLAGS_BYTE_SIZE + _CHUNK_NONCE_BYTE_SIZE
+
+# 归档：多个小文件存放在一个文件中，头部之后是各条目的密文，索引加密后放在最后，头部记录索引的位置和长度
+_ARCHIVE_MARKER = b'AES-A-0000000001'
+_ARCHIVE_POINTER_BYTE_SIZE = 8
+_ARCHIVE_HEAD_LENGTH = _HEAD_MARKER_BYTE_SIZE + _ARCHIVE_POINTER_BYTE_SIZE * 2
+
+_LAZY_ATTRS = {
+    # 核心功能，不依赖Qt
+    'Key': 'keymanager.key',
+    'KeyCache': 'keymanager.key',
+    'KEY_CACHE': 'keymanager.key',
+    'encrypt_data': 'keymanager.encryptor',
+    'decrypt_data': 'keymanager.encryptor',
+    'encrypt_file': 'keymanager.encryptor',
+    'decrypt_file': 'keymanager.encryptor',
+    'open_encrypted': 'keymanager.encfile',
+    'EncryptedFile': 'keymanager.encfile',
+    'EncryptedArchive': 'keymanager.archive',
+    # 图形界面，依赖PySide6和qtawesome
+    'getIcon': 'keymanager.utils',
+    'ICON_COLOR': 'keymanager.utils',
+    'KeyMgrDialog': 'keymanager.dialogs',
+    'KeyCreateDialog': 'keymanager.dialogs',
+    'EncryptFileDialog': 'keymanager.dialogs',
+    'show_add_key_dialog': 'keymanager.dialogs',
+    'add_keymanager_menu': 'keymanager.menus',
+}
+
+
+def __getattr__(name):
+    module_name = _LAZY_ATTRS.get(name)
+    if module_name is None:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+    value = getattr(importlib.import_module(module_name), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRS))
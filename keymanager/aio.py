@@ -0,0 +1,167 @@
+import asyncio
+import io
+import os
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor, CancelledError
+from functools import partial
+
+from keymanager import encryptor
+from keymanager.encryptor import FORMAT_V1, FORMAT_V3, _STREAM_CHUNK_SIZE
+from keymanager.key import Key, KEY_CACHE
+
+
+class AsyncRunner:
+
+    # 在线程池中执行阻塞的加解密和文件操作，同时执行的数量由信号量限制
+    def __init__(self, max_workers: int = None):
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _get_semaphore(self, loop) -> asyncio.Semaphore:
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_workers)
+            self._semaphores[loop] = semaphore
+        return semaphore
+
+    async def run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        async with self._get_semaphore(loop):
+            return await loop.run_in_executor(self._executor, partial(fn, *args, **kwargs))
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+
+
+_RUNNER = {'runner': None}
+
+
+def get_runner() -> AsyncRunner:
+    if _RUNNER['runner'] is None:
+        _RUNNER['runner'] = AsyncRunner()
+    return _RUNNER['runner']
+
+
+def set_max_concurrency(max_workers: int):
+    old_runner = _RUNNER['runner']
+    _RUNNER['runner'] = AsyncRunner(max_workers)
+    if old_runner is not None:
+        old_runner.shutdown(wait=False)
+
+
+async def encrypt_data(key, raw_data: bytes, version: int = FORMAT_V1) -> bytes:
+    return await get_runner().run(encryptor.encrypt_data, key, raw_data, version)
+
+
+async def decrypt_data(key, enc_data: bytes) -> bytes:
+    return await get_runner().run(encryptor.decrypt_data, key, enc_data)
+
+
+async def encrypt_file(key, src_path: str, dst_path: str, version: int = FORMAT_V1) -> int:
+    return await get_runner().run(encryptor.encrypt_file, key, src_path, dst_path, version=version)
+
+
+async def decrypt_file(key, src_path: str, dst_path: str) -> int:
+    return await get_runner().run(encryptor.decrypt_file, key, src_path, dst_path)
+
+
+# 加载密钥，add_to_cache为True时放入KEY_CACHE；缓存中已有相同id的密钥时重新加载缓存中的对象并返回，
+# 超时的密钥重新变为可用，持有这个对象的地方都能看到
+async def load_key(key_path: str, password: str = None, add_to_cache: bool = True) -> Key:
+    key = Key()
+    await get_runner().run(key.load, key_path, password)
+    if not add_to_cache:
+        return key
+    cached = KEY_CACHE.add_key(key)
+    if cached is not key:
+        await get_runner().run(cached.load, key_path, password)
+    return cached
+
+
+async def save_key(key: Key, key_path: str, password: str = None, calc_md5: bool = True):
+    await get_runner().run(key.save, key_path, password, calc_md5)
+
+
+# reader需要提供async read(n)，writer需要提供write()和async drain()，比如asyncio的StreamReader/StreamWriter。
+# 每写一块都会等待drain，下游处理不过来时不会继续读取上游。
+# reader和writer都不能seek，不知道length时只能使用v3流式格式：framed为None时按length是否为None决定，
+# version为None时流式格式使用v3，否则使用v1
+async def encrypt_stream(key, reader, writer, length: int = None, version: int = None,
+                         chunk_size: int = _STREAM_CHUNK_SIZE, framed: bool = None) -> int:
+    if framed is None:
+        framed = length is None
+    if version is None:
+        version = FORMAT_V3 if framed else FORMAT_V1
+    return await _run_stream(partial(encryptor.encrypt_stream, length=length, version=version, framed=framed),
+                             key, reader, writer, chunk_size)
+
+
+async def decrypt_stream(key, reader, writer, chunk_size: int = _STREAM_CHUNK_SIZE) -> int:
+    return await _run_stream(encryptor.decrypt_stream, key, reader, writer, chunk_size)
+
+
+async def _run_stream(processor, key, reader, writer, chunk_size: int) -> int:
+    loop = asyncio.get_running_loop()
+    canceled = threading.Event()
+    src = _LoopReader(reader, loop, canceled)
+    dst = _LoopWriter(writer, loop, canceled)
+    try:
+        return await get_runner().run(processor, key, src, dst, chunk_size)
+    except asyncio.CancelledError:
+        # 通知工作线程在下一次读写时退出
+        canceled.set()
+        src.cancel_pending()
+        dst.cancel_pending()
+        raise
+
+
+class _LoopIO(io.RawIOBase):
+
+    # 在工作线程中把读写转交给事件循环执行，供encryptor的同步流式接口使用
+    def __init__(self, stream, loop, canceled: threading.Event):
+        super().__init__()
+        self._stream = stream
+        self._loop = loop
+        self._canceled = canceled
+        self._pending = None
+
+    def _call(self, coro):
+        if self._canceled.is_set():
+            coro.close()
+            raise CancelledError()
+        self._pending = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        try:
+            return self._pending.result()
+        finally:
+            self._pending = None
+
+    def cancel_pending(self):
+        pending = self._pending
+        if pending is not None:
+            pending.cancel()
+
+
+class _LoopReader(_LoopIO):
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        return self._call(self._stream.read(size))
+
+
+class _LoopWriter(_LoopIO):
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._call(self._write(data))
+        return len(data)
+
+    async def _write(self, data: bytes):
+        self._stream.write(data)
+        await self._stream.drain()
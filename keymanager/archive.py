@@ -0,0 +1,296 @@
+import os
+import struct
+from typing import Dict, Iterator, List, NamedTuple
+
+from Crypto.Cipher import AES
+from Crypto import Random
+
+from keymanager import _HEAD_MARKER_BYTE_SIZE, _CHUNK_TAG_BYTE_SIZE, _ARCHIVE_MARKER, _ARCHIVE_POINTER_BYTE_SIZE, \
+    _ARCHIVE_HEAD_LENGTH
+from keymanager.atomic import AtomicFile, SyncGroup, atomic_write
+from keymanager.encryptor import InvalidEncryptDataException, _pread_full, _pwrite_full
+
+# 加密归档，很多小文件放在一个文件中，省去每个文件的头部和打开、关闭文件的开销：
+# | marker 16 | 索引位置 8 | 索引长度 8 | 条目密文 + 标签 | ... | 索引 |
+# 每个条目单独使用AES-GCM加密，nonce随机生成，条目名作为附加认证数据，条目之间不能互换；
+# 索引记录条目名、位置、明文长度和nonce，同样用AES-GCM加密：| nonce 12 | 密文 | 标签 16 |。
+# 追加时新条目和新索引写在文件末尾，落盘后才改写头部中的索引位置，
+# 中途崩溃时头部仍然指向旧索引，旧索引占用的空间不会回收，一次追加多个条目时只写一次索引
+
+_ARCHIVE_NONCE_BYTE_SIZE = 12
+# 条目位置、明文长度、nonce、条目名长度，后面是utf-8编码的条目名
+_INDEX_ENTRY = struct.Struct('>QQ{}sH'.format(_ARCHIVE_NONCE_BYTE_SIZE))
+_INDEX_COUNT = struct.Struct('>I')
+_MAX_NAME_LENGTH = 0xFFFF
+
+
+class ArchiveEntry(NamedTuple):
+    name: str
+    offset: int
+    length: int
+    nonce: bytes
+
+    @property
+    def stored_size(self) -> int:
+        return self.length + _CHUNK_TAG_BYTE_SIZE
+
+
+class EncryptedArchive:
+
+    # mode：'r'只读，'w'新建（覆盖已有文件，close时才出现在目标路径），'a'追加（文件不存在时新建）。
+    # 读取可以在多个线程中同时进行，写入不是线程安全的
+    def __init__(self, path: str, mode: str = 'r', key=None, durable: bool = True):
+        if mode not in ('r', 'w', 'a'):
+            raise ValueError('不支持的模式：{}'.format(mode))
+        if key is None:
+            raise ValueError('key不能为空')
+        self.path = path
+        self.durable = durable
+        self._key = key
+        self._entries: Dict[str, ArchiveEntry] = {}
+        self._atomic_file: AtomicFile = None
+        self._modified = False
+
+        if mode == 'a' and not os.path.exists(path):
+            mode = 'w'
+        self.mode = mode
+
+        if mode == 'w':
+            self._atomic_file = AtomicFile(path, durable=durable)
+            self._file = self._atomic_file.file
+            # 空归档也要写入索引
+            self._modified = True
+            self._end = _ARCHIVE_HEAD_LENGTH
+        else:
+            self._file = open(path, 'rb' if mode == 'r' else 'r+b')
+            try:
+                self._end = self._load_index()
+            except BaseException:
+                self._file.close()
+                raise
+        # 追加失败时截断到这里
+        self._base_end = self._end
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, name: str):
+        return name in self._entries
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._entries))
+
+    @property
+    def closed(self) -> bool:
+        return self._file.closed
+
+    def names(self) -> List[str]:
+        return list(self._entries)
+
+    def entries(self) -> List[ArchiveEntry]:
+        return list(self._entries.values())
+
+    def get_entry(self, name: str) -> ArchiveEntry:
+        return self._entries[name]
+
+    def read(self, name: str) -> bytes:
+        self._check_open()
+        entry = self._entries[name]
+        enc_data = _pread_full(self._file.fileno(), entry.stored_size, entry.offset)
+        if len(enc_data) != entry.stored_size:
+            raise InvalidEncryptDataException('加密数据不完整')
+        tag_pos = entry.length
+        cipher = AES.new(self._key, AES.MODE_GCM, nonce=entry.nonce)
+        cipher.update(entry.name.encode('utf-8'))
+        try:
+            return cipher.decrypt_and_verify(enc_data[:tag_pos], enc_data[tag_pos:])
+        except ValueError:
+            raise InvalidEncryptDataException('数据校验失败，{}已损坏或被篡改'.format(name))
+
+    def extract(self, name: str, dst_path: str, sync_group: SyncGroup = None) -> int:
+        data = self.read(name)
+        atomic_write(dst_path, data, sync_group, self.durable)
+        return len(data)
+
+    # 名称相同的条目会被替换，旧条目的空间不会回收
+    def add(self, name: str, data) -> ArchiveEntry:
+        self._check_writable()
+        name_bytes = name.encode('utf-8')
+        if not name_bytes or len(name_bytes) > _MAX_NAME_LENGTH:
+            raise ValueError('条目名长度必须在1到{}字节之间'.format(_MAX_NAME_LENGTH))
+
+        data = memoryview(data).cast('B')
+        nonce = Random.new().read(_ARCHIVE_NONCE_BYTE_SIZE)
+        cipher = AES.new(self._key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(name_bytes)
+        enc_data, tag = cipher.encrypt_and_digest(data)
+
+        entry = ArchiveEntry(name, self._end, len(data), nonce)
+        _pwrite_full(self._file.fileno(), enc_data + tag, entry.offset)
+        self._end += entry.stored_size
+        # 替换时放到最后，列出的顺序和写入的顺序一致
+        self._entries.pop(name, None)
+        self._entries[name] = entry
+        self._modified = True
+        return entry
+
+    def add_file(self, src_path: str, name: str = None) -> ArchiveEntry:
+        if name is None:
+            name = os.path.basename(src_path)
+        with open(src_path, 'rb') as f:
+            data = f.read()
+        return self.add(name, data)
+
+    def close(self):
+        if self.closed:
+            return
+        if self.mode == 'r' or not self._modified:
+            self._file.close()
+            return
+        try:
+            self._write_index()
+        except BaseException:
+            self.abort()
+            raise
+        if self._atomic_file is not None:
+            self._atomic_file.commit()
+        else:
+            self._file.close()
+
+    # 放弃本次写入的条目，新建的归档不会出现在目标路径，追加的归档恢复到打开时的状态
+    def abort(self):
+        if self.closed:
+            return
+        if self._atomic_file is not None:
+            self._atomic_file.discard()
+            return
+        try:
+            if self.mode == 'a' and self._modified:
+                self._file.truncate(self._base_end)
+        finally:
+            self._file.close()
+
+    def _check_open(self):
+        if self.closed:
+            raise ValueError('归档已关闭')
+
+    def _check_writable(self):
+        self._check_open()
+        if self.mode == 'r':
+            raise ValueError('归档是以只读模式打开的')
+
+    def _load_index(self) -> int:
+        fd = self._file.fileno()
+        file_size = os.fstat(fd).st_size
+        head = _pread_full(fd, _ARCHIVE_HEAD_LENGTH, 0)
+        if len(head) != _ARCHIVE_HEAD_LENGTH or bytes(head[:_HEAD_MARKER_BYTE_SIZE]) != _ARCHIVE_MARKER:
+            raise InvalidEncryptDataException('不是有效的加密归档')
+        pos = _HEAD_MARKER_BYTE_SIZE
+        index_offset = int.from_bytes(head[pos:pos + _ARCHIVE_POINTER_BYTE_SIZE], byteorder='big')
+        pos += _ARCHIVE_POINTER_BYTE_SIZE
+        index_size = int.from_bytes(head[pos:pos + _ARCHIVE_POINTER_BYTE_SIZE], byteorder='big')
+        if index_offset < _ARCHIVE_HEAD_LENGTH or index_size < _ARCHIVE_NONCE_BYTE_SIZE + _CHUNK_TAG_BYTE_SIZE \
+                or index_offset + index_size > file_size:
+            raise InvalidEncryptDataException('加密归档不完整')
+
+        index_data = _pread_full(fd, index_size, index_offset)
+        if len(index_data) != index_size:
+            raise InvalidEncryptDataException('加密归档不完整')
+        nonce = bytes(index_data[:_ARCHIVE_NONCE_BYTE_SIZE])
+        tag_pos = index_size - _CHUNK_TAG_BYTE_SIZE
+        cipher = AES.new(self._key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(_ARCHIVE_MARKER)
+        try:
+            index = cipher.decrypt_and_verify(index_data[_ARCHIVE_NONCE_BYTE_SIZE:tag_pos], index_data[tag_pos:])
+        except ValueError:
+            raise InvalidEncryptDataException('索引校验失败，密钥不正确或者归档已损坏')
+
+        self._entries = _parse_index(index, index_offset)
+        return file_size
+
+    def _write_index(self):
+        fd = self._file.fileno()
+        nonce = Random.new().read(_ARCHIVE_NONCE_BYTE_SIZE)
+        cipher = AES.new(self._key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(_ARCHIVE_MARKER)
+        enc_index, tag = cipher.encrypt_and_digest(_index_bytes(self._entries.values()))
+        index_data = nonce + enc_index + tag
+        index_offset = self._end
+        _pwrite_full(fd, index_data, index_offset)
+
+        head = _ARCHIVE_MARKER \
+            + index_offset.to_bytes(_ARCHIVE_POINTER_BYTE_SIZE, byteorder='big') \
+            + len(index_data).to_bytes(_ARCHIVE_POINTER_BYTE_SIZE, byteorder='big')
+        if self._atomic_file is not None:
+            # 新建的归档整体改名，由AtomicFile负责落盘
+            _pwrite_full(fd, head, 0)
+            return
+        # 条目和索引先落盘，再改写头部，头部不会指向没有写完的索引
+        if self.durable:
+            os.fsync(fd)
+        _pwrite_full(fd, head, 0)
+        if self.durable:
+            os.fsync(fd)
+
+
+def _index_bytes(entries) -> bytes:
+    entries = list(entries)
+    parts = [_INDEX_COUNT.pack(len(entries))]
+    for entry in entries:
+        name_bytes = entry.name.encode('utf-8')
+        parts.append(_INDEX_ENTRY.pack(entry.offset, entry.length, entry.nonce, len(name_bytes)))
+        parts.append(name_bytes)
+    return b''.join(parts)
+
+
+def _parse_index(index, index_offset: int) -> Dict[str, ArchiveEntry]:
+    if len(index) < _INDEX_COUNT.size:
+        raise InvalidEncryptDataException('索引损坏')
+    count, = _INDEX_COUNT.unpack_from(index, 0)
+    pos = _INDEX_COUNT.size
+    entries = {}
+    for _ in range(count):
+        if pos + _INDEX_ENTRY.size > len(index):
+            raise InvalidEncryptDataException('索引损坏')
+        offset, length, nonce, name_len = _INDEX_ENTRY.unpack_from(index, pos)
+        pos += _INDEX_ENTRY.size
+        name = bytes(index[pos:pos + name_len]).decode('utf-8')
+        pos += name_len
+        entry = ArchiveEntry(name, offset, length, nonce)
+        if offset < _ARCHIVE_HEAD_LENGTH or offset + entry.stored_size > index_offset:
+            raise InvalidEncryptDataException('索引损坏')
+        entries[name] = entry
+    if pos != len(index):
+        raise InvalidEncryptDataException('索引损坏')
+    return entries
+
+
+# 把文件加入归档，条目名是相对root的路径，统一使用'/'分隔；root为None时使用文件名
+def pack_files(key, archive_path: str, file_list: List[str], root: str = None, mode: str = 'a') -> int:
+    with EncryptedArchive(archive_path, mode, key) as archive:
+        for src_path in file_list:
+            if root is None:
+                name = os.path.basename(src_path)
+            else:
+                name = os.path.relpath(src_path, root).replace(os.sep, '/')
+            archive.add_file(src_path, name)
+    return len(file_list)
+
+
+def list_archive(key, archive_path: str) -> List[ArchiveEntry]:
+    with EncryptedArchive(archive_path, 'r', key) as archive:
+        return archive.entries()
+
+
+def extract_entry(key, archive_path: str, name: str, dst_path: str) -> int:
+    with EncryptedArchive(archive_path, 'r', key) as archive:
+        return archive.extract(name, dst_path)
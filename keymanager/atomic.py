@@ -0,0 +1,189 @@
+import os
+import stat
+import threading
+from contextlib import contextmanager
+from typing import List, Tuple
+
+# 原子写入：先写同目录下的临时文件，完成后改名覆盖目标文件，崩溃时目标文件要么是旧内容，要么是完整的新内容。
+# 已知输出大小时用posix_fallocate预先分配空间，写入过程中不会因为磁盘满留下半截文件，也减少碎片。
+# 单个文件在改名前fsync；批量处理时把文件交给SyncGroup，攒够一批后统一fsync、改名，
+# 每个目录只fsync一次，不会因为逐个fsync拖慢整批的速度。
+# 覆盖已有文件时沿用原文件的权限，新建文件时可以指定权限，比如密钥文件使用0o600
+
+_TEMP_SUFFIX = '.tmp'
+
+
+def _temp_path(path: str) -> str:
+    dir_name, name = os.path.split(os.path.abspath(path))
+    return os.path.join(dir_name, '.{}.{}{}'.format(name, os.urandom(4).hex(), _TEMP_SUFFIX))
+
+
+def _preallocate(fd, size: int) -> bool:
+    if size is None or size <= 0 or not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(fd, 0, size)
+        return True
+    except OSError:
+        # 部分文件系统不支持，不影响写入
+        return False
+
+
+def _fsync_path(path: str):
+    fd = os.open(path, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fsync_dir(dir_path: str):
+    # windows不能打开目录，改名本身由NTFS日志保证
+    if os.name == 'nt':
+        return
+    fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class SyncGroup:
+
+    # 批量写入时的组提交，add之后的文件在commit时才出现在目标路径
+    def __init__(self, max_files: int = 256, max_bytes: int = 256 * 1024 * 1024, durable: bool = True):
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.durable = durable
+        self._pending: List[Tuple[str, str]] = []
+        self._pending_bytes = 0
+        self._lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+
+    def add(self, tmp_path: str, path: str, size: int = 0):
+        with self._lock:
+            self._pending.append((tmp_path, path))
+            self._pending_bytes += size
+            full = len(self._pending) >= self.max_files or self._pending_bytes >= self.max_bytes
+        if full:
+            self.commit()
+
+    def commit(self):
+        with self._commit_lock:
+            with self._lock:
+                pending, self._pending = self._pending, []
+                self._pending_bytes = 0
+            if not pending:
+                return
+
+            # 数据先落盘再改名，改名后的文件不会是空的或不完整的
+            if self.durable:
+                for tmp_path, _ in pending:
+                    _fsync_path(tmp_path)
+            dirs = set()
+            for tmp_path, path in pending:
+                os.replace(tmp_path, path)
+                dirs.add(os.path.dirname(os.path.abspath(path)))
+            if self.durable:
+                for dir_path in dirs:
+                    _fsync_dir(dir_path)
+
+    def discard(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._pending_bytes = 0
+        for tmp_path, _ in pending:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # 出错时已经完成的文件仍然提交，和逐个写入时的结果一致
+        self.commit()
+
+
+class AtomicFile:
+
+    # size是输出的准确大小，用于预分配；不知道大小时传None。
+    # mode是新建文件的权限，目标文件已经存在时使用原文件的权限
+    def __init__(self, path: str, size: int = None, group: SyncGroup = None, durable: bool = True,
+                 mode: int = None):
+        self.path = path
+        self.size = size
+        self.group = group
+        self.durable = durable
+        self.mode = mode
+        self.tmp_path = _temp_path(path)
+        fd = os.open(self.tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0),
+                     0o666 if mode is None else mode)
+        self.file = os.fdopen(fd, 'wb')
+        try:
+            self._preallocated = _preallocate(self.file.fileno(), size)
+        except BaseException:
+            self.discard()
+            raise
+
+    def commit(self):
+        f = self.file
+        try:
+            f.flush()
+            # 预分配的空间比实际写入的多时截掉多余部分；通过fd按位置写入的调用方文件对象的位置不变，由调用方自己确定长度
+            if self._preallocated and 0 < f.tell() < self.size:
+                f.truncate()
+            self._copy_mode()
+            if self.group is None and self.durable:
+                os.fsync(f.fileno())
+        except BaseException:
+            self.discard()
+            raise
+        f.close()
+
+        if self.group is not None:
+            self.group.add(self.tmp_path, self.path, self.size or 0)
+            return
+        try:
+            os.replace(self.tmp_path, self.path)
+        except BaseException:
+            self.discard()
+            raise
+        if self.durable:
+            _fsync_dir(os.path.dirname(os.path.abspath(self.path)))
+
+    def _copy_mode(self):
+        # 改名会替换掉原文件的权限，先把原文件的权限复制到临时文件，0o600的密钥文件不会变成0o644
+        try:
+            mode = stat.S_IMODE(os.stat(self.path).st_mode)
+        except FileNotFoundError:
+            return
+        if hasattr(os, 'fchmod'):
+            os.fchmod(self.file.fileno(), mode)
+        else:
+            os.chmod(self.tmp_path, mode)
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+
+@contextmanager
+def atomic_open(path: str, size: int = None, group: SyncGroup = None, durable: bool = True, mode: int = None):
+    atomic_file = AtomicFile(path, size, group, durable, mode)
+    try:
+        yield atomic_file.file
+    except BaseException:
+        atomic_file.discard()
+        raise
+    atomic_file.commit()
+
+
+def atomic_write(path: str, data, group: SyncGroup = None, durable: bool = True, mode: int = None):
+    data = memoryview(data)
+    with atomic_open(path, data.nbytes, group, durable, mode) as f:
+        f.write(data)
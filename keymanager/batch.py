@@ -0,0 +1,176 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Iterator, List
+
+from axel import Event
+
+from keymanager.atomic import SyncGroup
+from keymanager.encryptor import encrypt_data, decrypt_data, encrypt_file, decrypt_file, is_encrypt_data, \
+    not_encrypt_data, FORMAT_V1, COMPRESS_NONE
+from keymanager.utils import read_file, write_file, read_header
+
+STATUS_DONE = 'done'
+STATUS_SKIPPED = 'skipped'
+STATUS_FAILED = 'failed'
+STATUS_CANCELED = 'canceled'
+
+# 内置的处理函数改用流式版本，避免把整个文件读入内存
+_FILE_PROCESSORS = {
+    encrypt_data: encrypt_file,
+    decrypt_data: decrypt_file,
+}
+
+
+class FileResult:
+
+    def __init__(self, src_path: str, dst_path: str):
+        self.src_path = src_path
+        self.dst_path = dst_path
+        self.status: str = None
+        self.error: Exception = None
+        self.length = 0
+
+    @property
+    def ok(self):
+        return self.status == STATUS_DONE
+
+
+class BatchProcessor:
+
+    # job(src_path, dst_path)处理单个文件；accept收到文件头部，返回False时跳过该文件。
+    # job的输出交给sync_group时，整批结束后统一提交
+    def __init__(self,
+                 job: Callable[[str, str], int],
+                 accept: Callable[[bytes], bool] = None,
+                 workers: int = None,
+                 sync_group: SyncGroup = None):
+        self.job = job
+        self.accept = accept
+        self.workers = workers or os.cpu_count() or 1
+        self.sync_group = sync_group
+
+        self._canceled = threading.Event()
+
+        # 回调在工作线程中执行
+        self.file_done = Event(threads=0)
+        self.file_failed = Event(threads=0)
+
+    def add_file_done_callback(self, cb: Callable[[FileResult], None]):
+        self.file_done += cb
+
+    def add_file_failed_callback(self, cb: Callable[[FileResult], None]):
+        self.file_failed += cb
+
+    def cancel(self):
+        self._canceled.set()
+
+    def was_canceled(self):
+        return self._canceled.is_set()
+
+    def process(self, file_list: List[str], output_dir: str) -> Iterator[FileResult]:
+        tasks = []
+        used_outputs = set()
+        for file_path in file_list:
+            _, name = os.path.split(file_path)
+            result = FileResult(file_path, os.path.join(output_dir, name))
+            # 并发写同一个输出文件会互相破坏
+            output_key = os.path.normcase(os.path.abspath(result.dst_path))
+            duplicated = output_key in used_outputs
+            used_outputs.add(output_key)
+            tasks.append((result, duplicated))
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(self._process_one, result, duplicated) for result, duplicated in tasks]
+                try:
+                    for future in as_completed(futures):
+                        yield future.result()
+                finally:
+                    for future in futures:
+                        future.cancel()
+        finally:
+            # 调用方提前结束或出错时，已经完成的文件也要提交，不会在输出目录中留下临时文件
+            if self.sync_group is not None:
+                self.sync_group.commit()
+
+    def run(self, file_list: List[str], output_dir: str) -> List[FileResult]:
+        return list(self.process(file_list, output_dir))
+
+    def _process_one(self, result: FileResult, duplicated: bool) -> FileResult:
+        try:
+            if self._canceled.is_set():
+                result.status = STATUS_CANCELED
+            elif duplicated:
+                raise FileExistsError('输出文件重名：{}'.format(result.dst_path))
+            elif not os.path.exists(result.src_path):
+                result.status = STATUS_SKIPPED
+            elif self.accept is not None and not self.accept(read_header(result.src_path)):
+                result.status = STATUS_SKIPPED
+            else:
+                result.length = self.job(result.src_path, result.dst_path)
+                result.status = STATUS_DONE
+        except Exception as e:
+            result.status = STATUS_FAILED
+            result.error = e
+
+        if result.status == STATUS_FAILED:
+            self.file_failed(result)
+        else:
+            self.file_done(result)
+        return result
+
+
+def make_job(key: bytes, processor: Callable = encrypt_data,
+             sync_group: SyncGroup = None) -> Callable[[str, str], int]:
+    file_processor = _FILE_PROCESSORS.get(processor)
+    if file_processor is not None:
+        def job(src_path, dst_path):
+            return file_processor(key, src_path, dst_path, sync_group=sync_group)
+        return job
+
+    # 自定义的处理函数只能处理完整的数据
+    def bytes_job(src_path, dst_path):
+        content = processor(key, read_file(src_path))
+        write_file(dst_path, content, sync_group)
+        return len(content)
+    return bytes_job
+
+
+def encrypt_files(key: bytes,
+                  file_list: List[str],
+                  output_dir: str,
+                  workers: int = None,
+                  version: int = FORMAT_V1,
+                  compression: int = COMPRESS_NONE,
+                  on_result: Callable[[FileResult], None] = None,
+                  on_error: Callable[[FileResult], None] = None) -> List[FileResult]:
+    sync_group = SyncGroup()
+
+    def job(src_path, dst_path):
+        return encrypt_file(key, src_path, dst_path, version=version, compression=compression,
+                            sync_group=sync_group)
+    return _run(BatchProcessor(job, not_encrypt_data, workers, sync_group), file_list, output_dir,
+                on_result, on_error)
+
+
+def decrypt_files(key: bytes,
+                  file_list: List[str],
+                  output_dir: str,
+                  workers: int = None,
+                  on_result: Callable[[FileResult], None] = None,
+                  on_error: Callable[[FileResult], None] = None) -> List[FileResult]:
+    sync_group = SyncGroup()
+
+    def job(src_path, dst_path):
+        return decrypt_file(key, src_path, dst_path, sync_group=sync_group)
+    return _run(BatchProcessor(job, is_encrypt_data, workers, sync_group), file_list, output_dir,
+                on_result, on_error)
+
+
+def _run(processor: BatchProcessor, file_list, output_dir, on_result, on_error) -> List[FileResult]:
+    if on_result is not None:
+        processor.add_file_done_callback(on_result)
+    if on_error is not None:
+        processor.add_file_failed_callback(on_error)
+    return processor.run(file_list, output_dir)
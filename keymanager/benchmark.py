@@ -0,0 +1,253 @@
+# 加解密吞吐量测试，使用自己生成的数据，不依赖外部服务。
+#
+#   python -m keymanager.benchmark
+#   python -m keymanager.benchmark --sizes 100,1M,4G --workers 8 --save baseline.json
+#   python -m keymanager.benchmark --compare baseline.json --threshold 0.1
+
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Dict, List
+
+from keymanager.encryptor import encrypt_data, decrypt_data, encrypt_file, decrypt_file, FORMAT_V1, FORMAT_V2, \
+    FORMAT_V3, COMPRESS_NONE, COMPRESS_ZLIB
+
+MODES = {
+    'v1': (FORMAT_V1, COMPRESS_NONE),
+    'v2': (FORMAT_V2, COMPRESS_NONE),
+    'v3': (FORMAT_V3, COMPRESS_NONE),
+    'v3-zlib': (FORMAT_V3, COMPRESS_ZLIB),
+}
+
+_UNITS = {'': 1, 'B': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+_PAYLOAD_BLOCK_SIZE = 1024 * 1024
+
+
+def parse_size(text: str) -> int:
+    text = text.strip().upper()
+    unit = text[-1] if text and text[-1] in _UNITS else ''
+    number = text[:-1] if unit else text
+    return int(float(number) * _UNITS[unit])
+
+
+def format_size(size: int) -> str:
+    for unit in ('G', 'M', 'K'):
+        if size >= _UNITS[unit] and size % _UNITS[unit] == 0:
+            return '{}{}'.format(size // _UNITS[unit], unit)
+    return '{}B'.format(size)
+
+
+def make_payload_block(size: int) -> bytes:
+    # 一半是类似日志/CSV的文本，一半是随机数据，压缩模式的结果才有参考意义
+    line = b'2024-01-01T00:00:00,INFO,keymanager,benchmark payload line,0123456789\n'
+    text = (line * (size // len(line) + 1))[:size - size // 2]
+    return text + os.urandom(size // 2)
+
+
+def write_payload_file(path: str, size: int):
+    block = make_payload_block(min(size, _PAYLOAD_BLOCK_SIZE))
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+
+
+def reset_peak_rss():
+    # linux可以重置VmHWM，其他平台只能得到进程启动以来的峰值
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def get_peak_rss() -> int:
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+    except ImportError:
+        return None
+
+
+def measure(fn, size: int, min_time: float, trace_alloc: bool) -> Dict:
+    gc.collect()
+    reset_peak_rss()
+    ops = 0
+    start = time.perf_counter()
+    elapsed = 0.0
+    while ops == 0 or elapsed < min_time:
+        fn()
+        ops += 1
+        elapsed = time.perf_counter() - start
+
+    result = {
+        'ops': ops,
+        'seconds': elapsed,
+        'mb_per_s': size * ops / elapsed / _UNITS['M'],
+        'ops_per_s': ops / elapsed,
+        'peak_rss': get_peak_rss(),
+    }
+
+    if trace_alloc:
+        # 单独执行一次统计python层面的内存分配，tracemalloc本身很慢，不计入耗时
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        fn()
+        after = tracemalloc.take_snapshot()
+        _, alloc_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result['alloc_peak'] = alloc_peak
+        result['alloc_blocks'] = sum(stat.count_diff for stat in after.compare_to(before, 'filename')
+                                     if stat.count_diff > 0)
+    return result
+
+
+def run_memory_cases(key: bytes, sizes: List[int], modes: List[str], min_time: float, trace_alloc: bool):
+    for size in sizes:
+        raw_data = make_payload_block(size)
+        for mode in modes:
+            version, compression = MODES[mode]
+            enc_data = encrypt_data(key, raw_data, version, compression=compression)
+            cases = (
+                ('encrypt_data', lambda: encrypt_data(key, raw_data, version, compression=compression)),
+                ('decrypt_data', lambda: decrypt_data(key, enc_data)),
+            )
+            for op, fn in cases:
+                result = measure(fn, size, min_time, trace_alloc)
+                result.update({'op': op, 'mode': mode, 'size': size, 'workers': 1})
+                yield result
+        del raw_data
+
+
+def run_file_cases(key: bytes, sizes: List[int], modes: List[str], workers: int, min_time: float,
+                   tmp_dir: str, trace_alloc: bool):
+    src_path = os.path.join(tmp_dir, 'plain')
+    enc_path = os.path.join(tmp_dir, 'encrypted')
+    out_path = os.path.join(tmp_dir, 'decrypted')
+    for size in sizes:
+        write_payload_file(src_path, size)
+        for mode in modes:
+            version, compression = MODES[mode]
+            # v1格式只能串行
+            worker_counts = [1] if version == FORMAT_V1 or workers <= 1 else [1, workers]
+            for worker_count in worker_counts:
+                def encrypt():
+                    encrypt_file(key, src_path, enc_path, version=version, workers=worker_count,
+                                 compression=compression)
+                result = measure(encrypt, size, min_time, trace_alloc)
+                result.update({'op': 'encrypt_file', 'mode': mode, 'size': size, 'workers': worker_count})
+                yield result
+
+            result = measure(lambda: decrypt_file(key, enc_path, out_path), size, min_time, trace_alloc)
+            result.update({'op': 'decrypt_file', 'mode': mode, 'size': size, 'workers': 1})
+            yield result
+
+
+def case_name(result: Dict) -> str:
+    return '{}/{}/{}/w{}'.format(result['op'], result['mode'], format_size(result['size']), result['workers'])
+
+
+def compare(results: List[Dict], baseline: Dict, threshold: float) -> List[str]:
+    base_results = {case_name(r): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        base = base_results.get(case_name(result))
+        if base is None:
+            continue
+        change = result['mb_per_s'] / base['mb_per_s'] - 1
+        result['change'] = change
+        if change < -threshold:
+            regressions.append('{}: {:.1f} MB/s -> {:.1f} MB/s ({:+.1%})'.format(
+                case_name(result), base['mb_per_s'], result['mb_per_s'], change))
+    return regressions
+
+
+def print_result(result: Dict):
+    peak_rss = result.get('peak_rss')
+    line = '{:<36} {:>10.1f} MB/s {:>12.1f} ops/s  rss {:>9}'.format(
+        case_name(result), result['mb_per_s'], result['ops_per_s'],
+        '-' if peak_rss is None else '{:.1f}M'.format(peak_rss / _UNITS['M']))
+    if 'alloc_peak' in result:
+        line += '  alloc {:>9} {:>6} blocks'.format('{:.1f}K'.format(result['alloc_peak'] / _UNITS['K']),
+                                                   result['alloc_blocks'])
+    if 'change' in result:
+        line += '  {:+.1%}'.format(result['change'])
+    print(line, flush=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m keymanager.benchmark', description='加解密吞吐量测试')
+    parser.add_argument('--sizes', default='100,10K,1M,64M', help='数据大小，逗号分隔，支持K/M/G后缀')
+    parser.add_argument('--max-memory-size', default='256M', help='超过这个大小只测试文件接口')
+    parser.add_argument('--modes', default=','.join(MODES), help='格式，可选：' + ','.join(MODES))
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='多线程测试的线程数')
+    parser.add_argument('--min-time', type=float, default=0.5, help='每项测试的最短时间（秒）')
+    parser.add_argument('--no-alloc', action='store_true', help='不统计内存分配')
+    parser.add_argument('--tmp-dir', default=None, help='文件测试使用的临时目录')
+    parser.add_argument('--save', default=None, help='把结果保存为基线JSON')
+    parser.add_argument('--compare', default=None, help='与基线JSON比较')
+    parser.add_argument('--threshold', type=float, default=0.1, help='吞吐量下降超过该比例视为退化')
+    args = parser.parse_args(argv)
+
+    sizes = [parse_size(s) for s in args.sizes.split(',') if s.strip()]
+    modes = [m.strip() for m in args.modes.split(',') if m.strip()]
+    for mode in modes:
+        if mode not in MODES:
+            parser.error('未知的格式：{}'.format(mode))
+    max_memory_size = parse_size(args.max_memory_size)
+    trace_alloc = not args.no_alloc
+
+    key = os.urandom(32)
+    results = []
+    tmp_dir = tempfile.mkdtemp(prefix='keymanager-bench-', dir=args.tmp_dir)
+    try:
+        memory_sizes = [s for s in sizes if s <= max_memory_size]
+        for result in run_memory_cases(key, memory_sizes, modes, args.min_time, trace_alloc):
+            results.append(result)
+            print_result(result)
+        for result in run_file_cases(key, sizes, modes, args.workers, args.min_time, tmp_dir,
+                                     trace_alloc):
+            results.append(result)
+            print_result(result)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print('退化 ' + regression)
+
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpu_count': os.cpu_count(),
+                'results': results,
+            }, f, indent=2)
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
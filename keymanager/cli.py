@@ -0,0 +1,382 @@
+# 命令行工具，不依赖PySide6，可以在没有图形界面的环境中批量处理文件。
+#
+#   keymanager keygen my.key --name 备份
+#   keymanager encrypt -k my.key -o out 'data/**/*.csv' -j 8
+#   keymanager decrypt -k my.key -o plain 'out/*'
+#   keymanager inspect 'out/*'
+#   keymanager verify -k my.key 'out/*'
+#   keymanager migrate 'keys/*.key'
+#   tar c dir | keymanager encrypt -k my.key - > dir.tar.enc
+#   keymanager-decrypt -k my.key < dir.tar.enc | tar x
+#
+# 路径只有一个"-"时从标准输入读取，结果写到标准输出，加密使用v3的流式格式，不需要知道数据长度。
+# 密码依次从--password-file、环境变量KEYMANAGER_PASSWORD读取，都没有时在终端中询问。
+# 为了启动快，各子命令用到的模块在执行时才导入
+
+import argparse
+import glob
+import os
+import sys
+
+PASSWORD_ENV = 'KEYMANAGER_PASSWORD'
+
+_FORMATS = {'v1': 1, 'v2': 2, 'v3': 3}
+_COMPRESSIONS = {'none': 0, 'zlib': 1, 'bz2': 2, 'lzma': 3}
+_FILTER_PATH = '-'
+_PIPE_BUFFER_SIZE = 1024 * 1024
+
+
+class CliError(Exception):
+    pass
+
+
+def expand_paths(patterns):
+    # 支持**递归匹配，没有匹配到任何文件的模式视为错误
+    paths = []
+    seen = set()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        matches = [path for path in matches if os.path.isfile(path)]
+        if not matches:
+            raise CliError('没有匹配的文件：{}'.format(pattern))
+        for path in matches:
+            path_key = os.path.normcase(os.path.abspath(path))
+            if path_key not in seen:
+                seen.add(path_key)
+                paths.append(path)
+    return paths
+
+
+def _has_terminal() -> bool:
+    # getpass从控制终端读取密码，不读stdin，stdin是管道时（tar c dir | keymanager-encrypt）也可以输入密码。
+    # 没有控制终端时getpass会退回到读取stdin，会吃掉要加密的数据，这种情况直接报错
+    if os.name == 'nt':
+        # windows下getpass直接读控制台
+        return sys.stdin.isatty() or sys.stderr.isatty()
+    try:
+        fd = os.open('/dev/tty', os.O_RDWR | os.O_NOCTTY)
+    except OSError:
+        return False
+    os.close(fd)
+    return True
+
+
+def read_password(args, prompt: str = '密码：', confirm: bool = False) -> str:
+    if args.password_file:
+        with open(args.password_file, 'r', encoding='utf-8') as f:
+            return f.readline().rstrip('\r\n')
+    if os.environ.get(PASSWORD_ENV):
+        return os.environ[PASSWORD_ENV]
+    if not _has_terminal():
+        raise CliError('需要密码，请使用--password-file或者环境变量{}'.format(PASSWORD_ENV))
+
+    import getpass
+    password = getpass.getpass(prompt)
+    if confirm and getpass.getpass('再次输入密码：') != password:
+        raise CliError('两次输入的密码不一致')
+    return password
+
+
+def load_key(args):
+    from keymanager.key import Key
+
+    if not os.path.isfile(args.key):
+        raise CliError('密钥文件不存在：{}'.format(args.key))
+    password = read_password(args) if Key.need_password(args.key) else None
+    key = Key()
+    try:
+        key.load(args.key, password)
+    except Exception as e:
+        raise CliError('不是有效的密钥文件：{}'.format(e))
+    return key
+
+
+def cmd_keygen(args) -> int:
+    from keymanager.key import Key
+
+    if os.path.exists(args.output):
+        raise CliError('目标文件已经存在：{}'.format(args.output))
+    password = None
+    if not args.no_password:
+        password = read_password(args, confirm=True)
+        illegal, msg = Key.is_password_illegal(password)
+        if illegal:
+            raise CliError(msg)
+
+    key = Key()
+    key.name = args.name or os.path.splitext(os.path.basename(args.output))[0]
+    key.key = os.urandom(32)
+    key.save(args.output, password, calc_md5=not args.no_md5)
+    _print(args, '{}\t{}\t{}'.format(key.id, key.name, args.output))
+    return 0
+
+
+def cmd_encrypt(args) -> int:
+    from keymanager.atomic import SyncGroup
+    from keymanager.batch import BatchProcessor
+    from keymanager.encryptor import encrypt_file, encrypt_stream, not_encrypt_data, FORMAT_V3
+
+    compression = _COMPRESSIONS[args.compress]
+    if _is_filter(args):
+        if args.format not in (None, 'v3'):
+            raise CliError('标准输入只能使用v3的流式格式')
+        if sys.stdout.isatty():
+            raise CliError('不能把密文输出到终端，请重定向标准输出')
+        raw_key = load_key(args).key
+        return _run_filter(lambda src, dst: encrypt_stream(raw_key, src, dst, args.chunk_size, version=FORMAT_V3,
+                                                           compression=compression, framed=True))
+
+    version = _FORMATS[args.format or 'v1']
+    if compression and version == 1:
+        raise CliError('v1格式不支持压缩，请使用--format v2或v3')
+    raw_key = load_key(args).key
+    sync_group = SyncGroup()
+
+    def job(src_path, dst_path):
+        return encrypt_file(raw_key, src_path, dst_path, version=version, compression=compression,
+                            sync_group=sync_group)
+    processor = BatchProcessor(job, None if args.force else not_encrypt_data, args.workers, sync_group)
+    return _run_batch(args, processor)
+
+
+def cmd_decrypt(args) -> int:
+    from keymanager.atomic import SyncGroup
+    from keymanager.batch import BatchProcessor
+    from keymanager.encryptor import decrypt_file, decrypt_stream, is_encrypt_data
+
+    raw_key = load_key(args).key
+    if _is_filter(args):
+        return _run_filter(lambda src, dst: decrypt_stream(raw_key, src, dst, args.chunk_size))
+    sync_group = SyncGroup()
+
+    def job(src_path, dst_path):
+        return decrypt_file(raw_key, src_path, dst_path, sync_group=sync_group)
+    processor = BatchProcessor(job, is_encrypt_data, args.workers, sync_group)
+    return _run_batch(args, processor)
+
+
+def _is_filter(args) -> bool:
+    if args.paths == [_FILTER_PATH]:
+        return True
+    if _FILTER_PATH in args.paths:
+        raise CliError('"-"不能和其他路径一起使用')
+    if args.output is None:
+        raise CliError('需要使用-o指定输出目录')
+    return False
+
+
+def _run_filter(processor) -> int:
+    # 用大的缓冲区读写管道，内存占用只和块大小有关
+    stdin_fd, stdout_fd = sys.stdin.fileno(), sys.stdout.fileno()
+    _grow_pipe(stdin_fd)
+    _grow_pipe(stdout_fd)
+    sys.stdout.flush()
+    with open(stdin_fd, 'rb', buffering=_PIPE_BUFFER_SIZE, closefd=False) as src, \
+            open(stdout_fd, 'wb', buffering=_PIPE_BUFFER_SIZE, closefd=False) as dst:
+        try:
+            processor(src, dst)
+        except Exception as e:
+            raise CliError(str(e))
+    return 0
+
+
+def _grow_pipe(fd):
+    # linux默认的管道只有64K，调大后读写的系统调用次数更少
+    try:
+        import fcntl
+        import stat
+        if stat.S_ISFIFO(os.fstat(fd).st_mode) and hasattr(fcntl, 'F_SETPIPE_SZ'):
+            fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, _PIPE_BUFFER_SIZE)
+    except (ImportError, OSError):
+        pass
+
+
+def _run_batch(args, processor) -> int:
+    from keymanager.batch import STATUS_DONE, STATUS_SKIPPED, STATUS_FAILED
+
+    file_list = expand_paths(args.paths)
+    os.makedirs(args.output, exist_ok=True)
+    counts = {}
+    for result in processor.process(file_list, args.output):
+        counts[result.status] = counts.get(result.status, 0) + 1
+        if result.status == STATUS_FAILED:
+            print('失败\t{}\t{}'.format(result.src_path, result.error), file=sys.stderr)
+        elif result.status == STATUS_DONE:
+            _print(args, '完成\t{}\t{}'.format(result.src_path, result.dst_path))
+        else:
+            _print(args, '跳过\t{}'.format(result.src_path))
+    _print(args, '共{}个文件，完成{}，跳过{}，失败{}'.format(
+        len(file_list), counts.get(STATUS_DONE, 0), counts.get(STATUS_SKIPPED, 0), counts.get(STATUS_FAILED, 0)))
+    return 1 if counts.get(STATUS_FAILED) else 0
+
+
+def cmd_inspect(args) -> int:
+    import json
+    from keymanager.scanner import scan_files
+
+    failed = False
+    for info in scan_files(expand_paths(args.paths), args.workers):
+        failed = failed or info.error is not None
+        if args.json:
+            print(json.dumps({
+                'path': info.path,
+                'size': info.size,
+                'encrypted': info.encrypted,
+                'version': info.version,
+                'data_len': info.data_len,
+                'error': None if info.error is None else str(info.error),
+            }, ensure_ascii=False))
+        elif info.error is not None:
+            print('{}\t错误\t{}'.format(info.path, info.error))
+        elif info.encrypted:
+            print('{}\tv{}\t{}\t{}'.format(info.path, info.version, info.size,
+                                          '流式' if info.data_len is None else info.data_len))
+        else:
+            print('{}\t未加密\t{}'.format(info.path, info.size))
+    return 1 if failed else 0
+
+
+def cmd_verify(args) -> int:
+    from concurrent.futures import ThreadPoolExecutor
+    from keymanager.encryptor import verify_file
+
+    key = load_key(args)
+    raw_key = key.key
+
+    def verify(path):
+        try:
+            return path, verify_file(raw_key, path), None
+        except Exception as e:
+            return path, False, e
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for path, authenticated, error in executor.map(verify, expand_paths(args.paths)):
+            if error is None:
+                _print(args, '{}\t{}'.format('正确' if authenticated else '正确（格式没有校验信息）', path))
+            else:
+                failed += 1
+                print('错误\t{}\t{}'.format(path, error), file=sys.stderr)
+    return 1 if failed else 0
+
+
+def cmd_migrate(args) -> int:
+    from keymanager.key import migrate_key_file
+
+    failed = 0
+    for path in expand_paths(args.paths):
+        try:
+            migrated = migrate_key_file(path)
+        except Exception as e:
+            failed += 1
+            print('错误\t{}\t{}'.format(path, e), file=sys.stderr)
+            continue
+        _print(args, '{}\t{}'.format('已转换' if migrated else '已经是新格式', path))
+    return 1 if failed else 0
+
+
+def _print(args, text: str):
+    if not args.quiet:
+        print(text, flush=True)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    # -q写在子命令前后都可以
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('-q', '--quiet', action='store_true', default=argparse.SUPPRESS, help='只输出错误')
+
+    parser = argparse.ArgumentParser(prog='keymanager', description='密钥管理和文件加解密')
+    parser.add_argument('-q', '--quiet', action='store_true', help='只输出错误')
+    sub_parsers = parser.add_subparsers(dest='command', metavar='命令')
+    sub_parsers.required = True
+
+    def add_password_args(sub_parser):
+        sub_parser.add_argument('--password-file', default=None,
+                                help='从文件的第一行读取密码，也可以使用环境变量' + PASSWORD_ENV)
+
+    def add_key_args(sub_parser):
+        sub_parser.add_argument('-k', '--key', required=True, help='密钥文件')
+        add_password_args(sub_parser)
+
+    def add_workers_args(sub_parser):
+        sub_parser.add_argument('-j', '--workers', type=int, default=os.cpu_count() or 1, help='并行处理的线程数')
+
+    def add_filter_args(sub_parser):
+        sub_parser.add_argument('-o', '--output', default=None, help='输出目录，从标准输入读取时不需要')
+        sub_parser.add_argument('--chunk-size', type=_parse_chunk_size, default=_PIPE_BUFFER_SIZE,
+                                help='从标准输入读取时的分块大小，必须是16的倍数')
+
+    keygen = sub_parsers.add_parser('keygen', help='创建密钥', parents=[common])
+    keygen.add_argument('output', help='密钥文件位置')
+    keygen.add_argument('--name', default=None, help='密钥名称，默认使用文件名')
+    keygen.add_argument('--no-password', action='store_true', help='不使用密码保护密钥文件')
+    keygen.add_argument('--no-md5', action='store_true', help='不记录密钥文件的md5')
+    add_password_args(keygen)
+    keygen.set_defaults(func=cmd_keygen)
+
+    encrypt = sub_parsers.add_parser('encrypt', help='加密文件', parents=[common])
+    add_key_args(encrypt)
+    add_filter_args(encrypt)
+    encrypt.add_argument('--format', choices=sorted(_FORMATS), default=None, help='加密格式，默认v1')
+    encrypt.add_argument('--compress', choices=list(_COMPRESSIONS), default='none', help='压缩算法，需要v2或v3格式')
+    encrypt.add_argument('--force', action='store_true', help='已经加密的文件也再加密一次')
+    add_workers_args(encrypt)
+    encrypt.add_argument('paths', nargs='+', help='文件或通配符，**匹配任意层目录；"-"表示标准输入')
+    encrypt.set_defaults(func=cmd_encrypt)
+
+    decrypt = sub_parsers.add_parser('decrypt', help='解密文件', parents=[common])
+    add_key_args(decrypt)
+    add_filter_args(decrypt)
+    add_workers_args(decrypt)
+    decrypt.add_argument('paths', nargs='+', help='文件或通配符，**匹配任意层目录；"-"表示标准输入')
+    decrypt.set_defaults(func=cmd_decrypt)
+
+    inspect = sub_parsers.add_parser('inspect', help='查看文件的加密格式，不需要密钥', parents=[common])
+    inspect.add_argument('--json', action='store_true', help='每行输出一个JSON对象')
+    add_workers_args(inspect)
+    inspect.add_argument('paths', nargs='+', help='文件或通配符，**匹配任意层目录')
+    inspect.set_defaults(func=cmd_inspect)
+
+    verify = sub_parsers.add_parser('verify', help='用密钥完整解密一遍，检查文件是否损坏', parents=[common])
+    add_key_args(verify)
+    add_workers_args(verify)
+    verify.add_argument('paths', nargs='+', help='文件或通配符，**匹配任意层目录')
+    verify.set_defaults(func=cmd_verify)
+
+    migrate = sub_parsers.add_parser('migrate', help='把旧格式的密钥文件转换为新格式，不需要密码', parents=[common])
+    migrate.add_argument('paths', nargs='+', help='密钥文件或通配符')
+    migrate.set_defaults(func=cmd_migrate)
+
+    return parser
+
+
+def _parse_chunk_size(text: str) -> int:
+    size = int(text)
+    if size <= 0 or size % 16 != 0:
+        raise argparse.ArgumentTypeError('必须是16的正整数倍')
+    return size
+
+
+def main(argv=None) -> int:
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    try:
+        return args.func(args)
+    except CliError as e:
+        print('错误：{}'.format(e), file=sys.stderr)
+        return 2
+    except KeyboardInterrupt:
+        return 130
+
+
+# keymanager-encrypt/keymanager-decrypt：从标准输入读取，写到标准输出
+def encrypt_filter_main(argv=None) -> int:
+    return main(['encrypt'] + (sys.argv[1:] if argv is None else argv) + [_FILTER_PATH])
+
+
+def decrypt_filter_main(argv=None) -> int:
+    return main(['decrypt'] + (sys.argv[1:] if argv is None else argv) + [_FILTER_PATH])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
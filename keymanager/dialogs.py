@@ -14,13 +14,17 @@ from keymanager.key import (
     Key,
     KEY_CACHE as key_cache,
     start_check_key_thread,
+    set_key_timeout,
     add_key_invalidate_callback,
-    KEY_CHECKER as key_checker, KeyTimeOutException)
+    KeyTimeOutException)
 from keymanager.ui._KeyCreateDialog import Ui_Dialog as UIKeyCreateDialog
 from keymanager.ui._KeyMgrDialog import Ui_Dialog as UIKeyMgrDialog
 from keymanager.ui._EncryptFileDialog import Ui_Dialog as UIEncryptFileDialog
 from keymanager.encryptor import is_encrypt_data, encrypt_data, decrypt_data, not_encrypt_data
-from keymanager.utils import read_file, write_file, ICON_COLOR as icon_color, getIcon
+from keymanager.utils import ICON_COLOR as icon_color, getIcon
+from keymanager.atomic import SyncGroup
+from keymanager.batch import BatchProcessor, make_job, STATUS_FAILED
+from keymanager.tree import TreeEncryptor, list_tree
 
 
 class KeyCreateDialog(QDialog, UIKeyCreateDialog):
@@ -112,6 +116,8 @@ class KeyMgrDialog(QDialog, UIKeyMgrDialog):
 
         self.key_list = key_cache.get_key_list()
         self.list_model = None
+        # 密钥id -> 列表中的行
+        self._items = {}
         self.setup_key_list(self.key_list)
 
         self.tbCreate.clicked.connect(self.create_key_action)
@@ -137,17 +143,16 @@ class KeyMgrDialog(QDialog, UIKeyMgrDialog):
         for key in key_list:
             item = self.make_item(key)
             self.list_model.appendRow(item)
+            self._items[key.id] = item
         self.keyListView.setModel(self.list_model)
         self.keyListView.setContextMenuPolicy(Qt.CustomContextMenu)
         self.keyListView.customContextMenuRequested[QPoint].connect(self.context_menu)
 
     def key_invalidate(self, invalidate_key: Key):
-        for i in range(self.list_model.rowCount()):
-            key = self.list_model.item(i).data()
-            if key.id == invalidate_key.id:
-                #self.list_model.item(i).setIcon(qta.icon('fa.warning', color=icon_color))
-                self.update_key_icon(self.list_model.item(i))
-                return
+        item = self._items.get(invalidate_key.id)
+        if item is not None:
+            #self.list_model.item(i).setIcon(qta.icon('fa.warning', color=icon_color))
+            self.update_key_icon(item)
 
     def update_key_icon(self, item):
         key = item.data()
@@ -193,6 +198,7 @@ class KeyMgrDialog(QDialog, UIKeyMgrDialog):
         pop_menu.addSeparator()
         _encrypt_files_action = pop_menu.addAction(qta.icon('ei.lock', color=icon_color['color'], color_active=icon_color['active']), "加密文件")
         _decrypt_files_action = pop_menu.addAction(qta.icon('ei.unlock', color=icon_color['color'], color_active=icon_color['active']), "解密文件")
+        _encrypt_dir_action = pop_menu.addAction(qta.icon('fa.folder', color=icon_color['color'], color_active=icon_color['active']), "加密目录")
         pop_menu.addSeparator()
 
         _reload_key_action = pop_menu.addAction(qta.icon('fa.refresh', color=icon_color['color'], color_active=icon_color['active']), "重新加载")
@@ -207,6 +213,8 @@ class KeyMgrDialog(QDialog, UIKeyMgrDialog):
             self.reload_key_action()
         elif selected_action == _decrypt_files_action:
             self.decrypt_files_action()
+        elif selected_action == _encrypt_dir_action:
+            self.encrypt_dir_action()
 
     def set_default_key_action(self, item=None):
 
@@ -228,11 +236,14 @@ class KeyMgrDialog(QDialog, UIKeyMgrDialog):
 
     def _add_key(self, item, key):
         self.list_model.appendRow(item)
+        self._items[key.id] = item
         key_cache.add_key(key)
 
     def _remove_key(self, index):
+        key = self.list_model.item(index).data()
+        self._items.pop(key.id, None)
         self.list_model.removeRow(index)
-        key_cache.remove_key(index)
+        key_cache.remove(key.id)
 
     def _set_default_key(self, item):
         key_cache.set_current_key(item.data())
@@ -244,6 +255,16 @@ class KeyMgrDialog(QDialog, UIKeyMgrDialog):
         if len(file_name.strip()) == 0:
             return
 
+        # 只读取id，已经加载的密钥不需要再输入密码
+        try:
+            key_id = Key.peek(file_name).id
+        except Exception as e:
+            QMessageBox.critical(self, '错误', '不是有效的密钥文件<br/>' + str(e))
+            return
+        if key_cache.contains(key_id):
+            QMessageBox.information(self, '信息', '相同的密钥已经加载')
+            return
+
         password = None
         if Key.need_password(file_name):
             ok_pressed = True
@@ -265,13 +286,9 @@ class KeyMgrDialog(QDialog, UIKeyMgrDialog):
             QMessageBox.critical(self, '错误', '不是有效的密钥文件<br/>' + str(e))
             return
 
-        row_len = self.list_model.rowCount()
-        for i in range(0, row_len):
-            item: QStandardItem = self.list_model.item(i, 0)
-            k: Key = item.data()
-            if k.id == key.id:
-                QMessageBox.information(self, '信息', '相同的密钥已经加载')
-                return
+        if key_cache.contains(key.id):
+            QMessageBox.information(self, '信息', '相同的密钥已经加载')
+            return
 
         item = self.make_item(key)
         self._add_key(item, key)
@@ -305,6 +322,10 @@ class KeyMgrDialog(QDialog, UIKeyMgrDialog):
         ef_dialog.set_key(key)
         ef_dialog.exec()
 
+    def encrypt_dir_action(self):
+        item = self.get_selected_item()
+        open_encrypt_dir_dialog(item.data(), parent=self)
+
     def reload_key_action(self):
         item = self.get_selected_item()
         key: Key = item.data()
@@ -404,45 +425,15 @@ class EncryptFileDialog(QDialog, UIEncryptFileDialog):
     def do_it(self):
         if not self.check_input():
             return
-        pd = QProgressDialog(self)
-        pd.setMinimumDuration(10)
-        pd.setAutoClose(True)
-        pd.setAutoReset(False)
-        pd.setLabelText('正在处理')
-        pd.setCancelButtonText('取消')
-        pd.setRange(0, len(self.file_list))
-        pd.setValue(0)
-        pd.setWindowModality(Qt.WindowModal)
-        pd.show()
-
+        sync_group = SyncGroup()
         try:
-            for index, file_path in enumerate(self.file_list):
-
-                if pd.wasCanceled():
-                    break
-
-                pd.setLabelText('正在处理 {}/{}'.format(str(index + 1), len(self.file_list)))
-
-                if os.path.exists(file_path):
-
-                    p, n = os.path.split(file_path)
-                    file_content = read_file(file_path)
-
-                    if self.before_process(file_content):
-                        encrypt_content = self.processor(self.key.key, file_content)
-                        output_file = os.path.join(self.output_dir_path, n)
-                        write_file(output_file, encrypt_content)
-
-                pd.setValue(pd.value() + 1)
-
-            if not pd.wasCanceled():
-                QMessageBox.information(pd, '处理完成', self.success_msg)
-            else:
-                QMessageBox.information(pd, '已经终止', '用户取消')
-        except Exception as e:
-            pass
-            QMessageBox.critical(pd, '处理失败', str(e))
-        pd.close()
+            job = make_job(self.key.key, self.processor, sync_group)
+        except KeyTimeOutException:
+            QMessageBox.critical(self, '处理失败', '密钥已经失效，请重新加载')
+            return
+        processor = BatchProcessor(job, self.before_process, sync_group=sync_group)
+        run_batch_with_progress(self, processor, self.file_list, self.output_dir_path,
+                                success_msg=self.success_msg, min_duration=10)
         self.close()
 
 
@@ -462,44 +453,89 @@ def open_encrypt_files_dialog(key: Key,
     if dir_path == '' or not os.path.exists(dir_path):
         return
 
+    sync_group = SyncGroup()
+    try:
+        job = make_job(key.key, encrypt_data, sync_group)
+    except KeyTimeOutException:
+        QMessageBox.critical(parent, '处理失败', '密钥已经失效，请重新加载')
+        return
+    processor = BatchProcessor(job, not_encrypt_data, sync_group=sync_group)
+    run_batch_with_progress(parent, processor, file_list, dir_path,
+                            progress_title=progress_title, success_msg='加密完成', min_duration=1000)
+
+
+# 加密整个目录，输出目录中保持原来的目录结构
+def open_encrypt_dir_dialog(key: Key,
+                            progress_title='正在加密',
+                            caption_src_dir='选择需要加密的目录',
+                            caption_output_dir='选择输出目录',
+                            parent=None):
+    src_dir = QFileDialog.getExistingDirectory(parent, caption_src_dir, "C:/")
+    if src_dir == '' or not os.path.exists(src_dir):
+        return
+
+    dir_path = QFileDialog.getExistingDirectory(None, caption_output_dir, "C:/")
+    if dir_path == '' or not os.path.exists(dir_path):
+        return
+
+    if os.path.normcase(os.path.abspath(src_dir)) == os.path.normcase(os.path.abspath(dir_path)):
+        QMessageBox.information(parent, '', '输出目录不能与源目录相同')
+        return
+
+    try:
+        processor = TreeEncryptor(key.key, src_dir)
+    except KeyTimeOutException:
+        QMessageBox.critical(parent, '处理失败', '密钥已经失效，请重新加载')
+        return
+    file_list = list_tree(src_dir, dir_path)
+    if len(file_list) == 0:
+        QMessageBox.information(parent, '', '目录中没有文件')
+        return
+    run_batch_with_progress(parent, processor, file_list, dir_path,
+                            progress_title=progress_title, success_msg='加密完成', min_duration=1000)
+
+
+def run_batch_with_progress(parent,
+                            processor: BatchProcessor,
+                            file_list,
+                            output_dir,
+                            progress_title='正在处理',
+                            success_msg='处理完成',
+                            min_duration=1000):
     pd = QProgressDialog(parent)
-    pd.setMinimumDuration(1000)
+    pd.setMinimumDuration(min_duration)
     pd.setAutoClose(True)
     pd.setAutoReset(False)
-    pd.setLabelText('正在处理')
+    pd.setLabelText(progress_title)
     pd.setCancelButtonText('取消')
     pd.setRange(0, len(file_list))
     pd.setValue(0)
     pd.setWindowModality(Qt.WindowModal)
     pd.show()
 
+    failed = []
     try:
-        for index, file_path in enumerate(file_list):
+        for index, result in enumerate(processor.process(file_list, output_dir)):
 
             if pd.wasCanceled():
-                break
+                processor.cancel()
 
-            pd.setLabelText('正在处理 {}/{}'.format(str(index + 1), len(file_list)))
+            pd.setLabelText('{} {}/{}'.format(progress_title, str(index + 1), len(file_list)))
 
-            if os.path.exists(file_path):
+            if result.status == STATUS_FAILED:
+                failed.append(result)
 
-                p, n = os.path.split(file_path)
-                file_content = read_file(file_path)
+            pd.setValue(index + 1)
 
-                if not is_encrypt_data(file_content):
-                    encrypt_content = encrypt_data(key.key, file_content)
-                    output_file = os.path.join(dir_path, n)
-                    write_file(output_file, encrypt_content)
-
-            pd.setValue(pd.value() + 1)
-
-        if not pd.wasCanceled():
-            QMessageBox.information(pd, '处理完成', '加密完成')
+        if len(failed) > 0:
+            errors = ['{}：{}'.format(result.src_path, str(result.error)) for result in failed]
+            QMessageBox.critical(pd, '处理失败', '<br/>'.join(errors))
+        elif not processor.was_canceled():
+            QMessageBox.information(pd, '处理完成', success_msg)
         else:
             QMessageBox.information(pd, '已经终止', '用户取消')
 
     except Exception as e:
-        pass
         QMessageBox.critical(pd, '处理失败', str(e))
 
     pd.close()
@@ -511,6 +547,16 @@ def show_add_key_dialog(parent) -> Key:
     if len(file_name.strip()) == 0:
         return None
 
+    # 只读取id，已经加载的密钥不需要再输入密码
+    try:
+        key_id = Key.peek(file_name).id
+    except Exception as e:
+        QMessageBox.critical(parent, '错误', '不是有效的密钥文件<br/>' + str(e))
+        return None
+    if key_cache.contains(key_id):
+        QMessageBox.information(parent, '信息', '相同的密钥已经加载')
+        return None
+
     password = None
     if Key.need_password(file_name):
         ok_pressed = True
@@ -532,10 +578,9 @@ def show_add_key_dialog(parent) -> Key:
         QMessageBox.critical(parent, '错误', '不是有效的密钥文件<br/>' + str(e))
         return None
 
-    for k in key_cache.get_key_list():
-        if k.id == key.id:
-            QMessageBox.information(parent, '信息', '相同的密钥已经加载')
-            return None
+    if key_cache.contains(key.id):
+        QMessageBox.information(parent, '信息', '相同的密钥已经加载')
+        return None
 
     key_cache.add_key(key)
 
@@ -543,7 +588,7 @@ def show_add_key_dialog(parent) -> Key:
 
 
 if __name__ == '__main__':
-    key_checker['timeout'] = 60
+    set_key_timeout(60)
     start_check_key_thread()
     app = QApplication(sys.argv)
     kmd = KeyMgrDialog()
@@ -0,0 +1,308 @@
+import io
+from functools import partial
+
+from Crypto.Cipher import AES
+
+from keymanager import _HEAD_LENGTH, _CHUNKED_HEAD_LENGTH, _CHUNK_INDEX_ENTRY_SIZE
+from keymanager.atomic import AtomicFile
+from keymanager.encryptor import parse_header, parse_chunked_header, get_format_version, \
+    InvalidEncryptDataException, FORMAT_V1, COMPRESS_NONE, _STREAM_CHUNK_SIZE, _check_chunk_size, _read_full, \
+    _aligned_size, _parse_index, _decrypt_chunk, _iter_frames, _new_framed_header, _frame_bytes
+
+# 类文件对象，读取时按块解密，写入时按块加密，内存中只保留当前块。
+# 可以seek的格式：
+#   v2/v3：通过索引定位到块，只解密读到的块
+#   v1：CBC模式下任意一块用前一个密文块作为IV就能解密，头部以IV结尾，第一块也一样
+# v3流式格式没有索引，只能顺序读取。
+# 写入不知道最终长度，总是使用v3流式格式，写入临时文件，close时才出现在目标路径。
+# with块中出现异常或者调用abort时丢弃临时文件，不会写最后一块，不完整的数据不会被当作完整的文件
+
+
+class EncryptedFile(io.RawIOBase):
+
+    # mode为'r'或'w'；读取时chunk_size只影响v1格式每次解密的大小，分块格式使用文件中记录的块大小
+    def __init__(self, path: str, mode: str, key,
+                 chunk_size: int = _STREAM_CHUNK_SIZE, compression: int = COMPRESS_NONE):
+        super().__init__()
+        if mode not in ('r', 'w'):
+            raise ValueError('不支持的模式：{}'.format(mode))
+        _check_chunk_size(chunk_size)
+        self.name = path
+        self.mode = mode + 'b'
+        self._key = key
+        self._pos = 0
+        self._file = None
+        self._dst = None
+
+        # 当前缓存的块
+        self._chunk_idx = -1
+        self._chunk = b''
+
+        if mode == 'w':
+            self._header = _new_framed_header(chunk_size, compression)
+            self._chunk_size = chunk_size
+            self._buffer = bytearray()
+            dst = AtomicFile(path)
+            try:
+                dst.file.write(self._header.to_bytes())
+            except BaseException:
+                dst.discard()
+                raise
+            self._dst = dst
+            return
+
+        self._file = open(path, 'rb')
+        try:
+            self._open_reader(chunk_size)
+        except BaseException:
+            self._file.close()
+            raise
+
+    def _open_reader(self, chunk_size: int):
+        head = _read_full(self._file, _CHUNKED_HEAD_LENGTH)
+        self._version = get_format_version(head)
+        if self._version is None:
+            raise InvalidEncryptDataException('不是有效的加密数据')
+        self._frames = None
+
+        if self._version == FORMAT_V1:
+            if len(head) < _HEAD_LENGTH:
+                raise InvalidEncryptDataException('不是有效的加密数据')
+            self._size, self._iv = parse_header(head)
+            self._chunk_size = chunk_size
+            return
+
+        self._header = parse_chunked_header(head)
+        self._chunk_size = self._header.chunk_size
+        if self._header.framed:
+            self._size = None
+            self._frames = _iter_frames(self._key, self._header, partial(_read_full, self._file))
+            return
+        self._size = self._header.data_len
+        index_len = (self._header.chunk_count + 1) * _CHUNK_INDEX_ENTRY_SIZE
+        self._offsets = _parse_index(_read_full(self._file, index_len), self._header.chunk_count)
+
+    def readable(self) -> bool:
+        self._checkClosed()
+        return self._file is not None
+
+    def writable(self) -> bool:
+        self._checkClosed()
+        return self._dst is not None
+
+    def seekable(self) -> bool:
+        self._checkClosed()
+        return self._file is not None and self._frames is None
+
+    def tell(self) -> int:
+        self._checkClosed()
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if not self.seekable():
+            raise io.UnsupportedOperation('流式格式只能顺序读取')
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._size + offset
+        else:
+            raise ValueError('不支持的whence：{}'.format(whence))
+        if pos < 0:
+            raise ValueError('位置不能为负数')
+        self._pos = pos
+        return pos
+
+    @property
+    def size(self):
+        # 明文长度，流式格式读完之前不知道长度，返回None
+        return self._size
+
+    def readinto(self, b) -> int:
+        if not self.readable():
+            raise io.UnsupportedOperation('文件不是以读取模式打开的')
+        view = memoryview(b).cast('B')
+        # 一次尽量填满，大块读取时不会退化成很多次小的复制
+        total = 0
+        while total < len(view):
+            chunk = self._chunk_at(self._pos)
+            if chunk is None:
+                break
+            offset = self._pos - self._chunk_idx * self._chunk_size
+            size = min(len(view) - total, len(chunk) - offset)
+            if size <= 0:
+                break
+            view[total:total + size] = chunk[offset:offset + size]
+            total += size
+            self._pos += size
+        return total
+
+    def readall(self) -> bytes:
+        parts = []
+        while True:
+            data = self.read(max(self._chunk_size, 1))
+            if not data:
+                return b''.join(parts)
+            parts.append(data)
+
+    def _chunk_at(self, pos: int):
+        idx = pos // self._chunk_size
+        if idx == self._chunk_idx:
+            return self._chunk
+
+        if self._frames is not None:
+            # 不能seek，位置只会移到下一块
+            chunk = next(self._frames, None)
+            if chunk is None:
+                self._size = self._pos
+                return None
+            if self._size is None and len(chunk) < self._chunk_size:
+                self._size = idx * self._chunk_size + len(chunk)
+        elif pos >= self._size:
+            return None
+        elif self._version == FORMAT_V1:
+            chunk = self._read_v1_chunk(idx)
+        else:
+            start, end = self._offsets[idx], self._offsets[idx + 1]
+            self._file.seek(start)
+            chunk = _decrypt_chunk(self._key, self._header, idx, _read_full(self._file, end - start))
+
+        self._chunk_idx = idx
+        self._chunk = chunk
+        return chunk
+
+    def _read_v1_chunk(self, idx: int) -> bytes:
+        start = idx * self._chunk_size
+        data_len = min(self._chunk_size, self._size - start)
+        enc_len = _aligned_size(data_len)
+        if start == 0:
+            iv = self._iv
+            self._file.seek(_HEAD_LENGTH)
+        else:
+            self._file.seek(_HEAD_LENGTH + start - AES.block_size)
+            iv = _read_full(self._file, AES.block_size)
+        enc_chunk = _read_full(self._file, enc_len)
+        if len(iv) != AES.block_size or len(enc_chunk) != enc_len:
+            raise InvalidEncryptDataException('加密数据不完整')
+        return AES.new(self._key, AES.MODE_CBC, bytes(iv)).decrypt(enc_chunk)[:data_len]
+
+    def write(self, b) -> int:
+        if not self.writable():
+            raise io.UnsupportedOperation('文件不是以写入模式打开的')
+        data = memoryview(b).cast('B')
+        self._buffer += data
+        # 最后一块要在close时写入，缓冲区正好满一块时先留着
+        write_size = (len(self._buffer) - 1) // self._chunk_size * self._chunk_size
+        if write_size > 0:
+            for start in range(0, write_size, self._chunk_size):
+                self._write_frame(self._buffer[start:start + self._chunk_size], False)
+            del self._buffer[:write_size]
+        self._pos += len(data)
+        return len(data)
+
+    def _write_frame(self, raw_chunk, last: bool):
+        self._dst.file.write(_frame_bytes(self._key, self._header, self._chunk_idx + 1, raw_chunk, last))
+        self._chunk_idx += 1
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+    # 放弃写入，目标路径保持原样；读取时与close相同
+    def abort(self):
+        if self.closed:
+            return
+        try:
+            if self._dst is not None:
+                self._dst.discard()
+                self._buffer = bytearray()
+            elif self._file is not None:
+                self._file.close()
+        finally:
+            self._chunk = b''
+            super().close()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if self._dst is not None:
+                try:
+                    self._write_frame(self._buffer, True)
+                except BaseException:
+                    self._dst.discard()
+                    raise
+                self._dst.commit()
+                self._buffer = bytearray()
+            elif self._file is not None:
+                self._file.close()
+        finally:
+            self._chunk = b''
+            super().close()
+
+
+# 按open的方式打开加密文件，支持'r'、'rb'、'w'、'wb'以及对应的't'模式；
+# 二进制模式返回BufferedReader/BufferedWriter，文本模式再套一层TextIOWrapper
+def open_encrypted(path: str, mode: str = 'rb', key=None,
+                   encoding: str = None, errors: str = None, newline: str = None,
+                   buffering: int = -1,
+                   chunk_size: int = _STREAM_CHUNK_SIZE, compression: int = COMPRESS_NONE):
+    if key is None:
+        raise ValueError('key不能为空')
+    modes = set(mode)
+    if len(mode) != len(modes) or not modes <= set('rwbt') or len(modes & set('rw')) != 1 \
+            or modes >= set('bt'):
+        raise ValueError('不支持的模式：{}'.format(mode))
+    binary = 'b' in modes
+    if binary and (encoding is not None or errors is not None or newline is not None):
+        raise ValueError('二进制模式不能指定encoding、errors或newline')
+    if buffering == 0 and not binary:
+        raise ValueError('文本模式必须使用缓冲')
+
+    raw = EncryptedFile(path, 'r' if 'r' in modes else 'w', key, chunk_size, compression)
+    if buffering == 0:
+        return raw
+    if buffering < 0:
+        buffering = io.DEFAULT_BUFFER_SIZE
+    try:
+        if raw.readable():
+            buffered = io.BufferedReader(raw, buffering)
+        else:
+            buffered = _BufferedWriter(raw, buffering)
+        if binary:
+            return buffered
+        text = _TextIOWrapper(buffered, encoding, errors, newline)
+        text.mode = mode
+        return text
+    except BaseException:
+        raw.close()
+        raise
+
+
+# with块中出现异常时先放弃底层的EncryptedFile，再关闭缓冲层，缓冲中的数据不会写出，也不会提交
+class _BufferedWriter(io.BufferedWriter):
+
+    def abort(self):
+        self.raw.abort()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.abort()
+        return super().__exit__(exc_type, exc_val, exc_tb)
+
+
+class _TextIOWrapper(io.TextIOWrapper):
+
+    def abort(self):
+        if isinstance(self.buffer, _BufferedWriter):
+            self.buffer.abort()
+        else:
+            self.close()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.abort()
+        return super().__exit__(exc_type, exc_val, exc_tb)
@@ -1,8 +1,53 @@
+import bz2
+import io
+import lzma
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from typing import Callable, Dict, List, NamedTuple
+
 from Crypto.Cipher import AES
 from Crypto import Random
 from Crypto.Util.Padding import pad, unpad
 
-from keymanager import _HEAD_MARKER, _HEAD_FILE_SIZE_BYTE_SIZE, _HEAD_LENGTH, _HEAD_MARKER_BYTE_SIZE
+from keymanager.atomic import atomic_open, SyncGroup
+from keymanager import _HEAD_MARKER, _HEAD_FILE_SIZE_BYTE_SIZE, _HEAD_LENGTH, _HEAD_MARKER_BYTE_SIZE, \
+    _HEAD_MARKER_V2, _CHUNK_SIZE_BYTE_SIZE, _CHUNK_FLAGS_BYTE_SIZE, _CHUNK_NONCE_BYTE_SIZE, \
+    _CHUNK_INDEX_ENTRY_SIZE, _CHUNKED_HEAD_LENGTH, _HEAD_MARKER_V3, _CHUNK_TAG_BYTE_SIZE, _FRAME_LENGTH_BYTE_SIZE
+
+# 流式加解密每次读取的数据大小，必须是AES块大小的整数倍；v2格式下同时也是分块大小
+_STREAM_CHUNK_SIZE = 1024 * 1024
+
+FORMAT_V1 = 1
+FORMAT_V2 = 2
+FORMAT_V3 = 3
+
+_HEAD_MARKERS = {
+    _HEAD_MARKER: FORMAT_V1,
+    _HEAD_MARKER_V2: FORMAT_V2,
+    _HEAD_MARKER_V3: FORMAT_V3,
+}
+
+# 分块格式头部flags的低8位记录压缩算法，每块先压缩再加密
+COMPRESS_NONE = 0
+COMPRESS_ZLIB = 1
+COMPRESS_BZ2 = 2
+COMPRESS_LZMA = 3
+_COMPRESSION_MASK = 0xFF
+# 流式格式，只能用于v3
+_FLAG_FRAMED = 0x100
+# 流式格式块长度字段的最高位，表示最后一块
+_FRAME_LAST = 1 << (_FRAME_LENGTH_BYTE_SIZE * 8 - 1)
+
+
+class InvalidEncryptDataException(Exception):
+    pass
 
 
 def pad_key(key, key_length=32):
@@ -13,7 +58,10 @@ def generate_iv() -> bytes:
     return Random.new().read(AES.block_size)
 
 
-def encrypt_data(key, raw_data: bytes) -> bytes:
+def encrypt_data(key, raw_data: bytes, version: int = FORMAT_V1, chunk_size: int = _STREAM_CHUNK_SIZE,
+                 compression: int = COMPRESS_NONE) -> bytes:
+    if version != FORMAT_V1 or compression != COMPRESS_NONE:
+        return _encrypt_chunked(key, raw_data, version, chunk_size, compression)
     data_len = len(raw_data)
     iv, enc_data = encrypt_data1(key, raw_data)
     bytes_array = bytearray()
@@ -33,13 +81,13 @@ def encrypt_data1(key, raw_data: bytes):
 
 def decrypt_data(key, enc_data: bytes) -> bytes:
 
-    if not is_encrypt_data(enc_data):
+    version = get_format_version(enc_data)
+    if version is None:
         return b''
+    if version != FORMAT_V1:
+        return b''.join(_iter_chunked_view(key, memoryview(enc_data).cast('B')))
 
-    data_len_bytes = enc_data[_HEAD_MARKER_BYTE_SIZE:_HEAD_FILE_SIZE_BYTE_SIZE + _HEAD_MARKER_BYTE_SIZE]
-    data_len = int.from_bytes(data_len_bytes, byteorder='big')
-
-    iv = enc_data[_HEAD_FILE_SIZE_BYTE_SIZE + _HEAD_MARKER_BYTE_SIZE:_HEAD_LENGTH]
+    data_len, iv = parse_header(enc_data)
 
     cipher = AES.new(key, AES.MODE_CBC, iv)
     raw_data = cipher.decrypt(enc_data[_HEAD_LENGTH:])
@@ -54,12 +102,978 @@ def decrypt_data1(key, iv, length, enc_data: bytes):
     return raw_data[:length]
 
 
-def is_encrypt_data(enc_data: bytes):
-    marker_bytes = enc_data[:_HEAD_MARKER_BYTE_SIZE]
-    if marker_bytes.hex() == _HEAD_MARKER.hex():
-        return True
+def parse_header(enc_data: bytes):
+    data_len_bytes = enc_data[_HEAD_MARKER_BYTE_SIZE:_HEAD_FILE_SIZE_BYTE_SIZE + _HEAD_MARKER_BYTE_SIZE]
+    data_len = int.from_bytes(data_len_bytes, byteorder='big')
+    iv = enc_data[_HEAD_FILE_SIZE_BYTE_SIZE + _HEAD_MARKER_BYTE_SIZE:_HEAD_LENGTH]
+    return data_len, iv
+
+
+def make_header(data_len: int, iv: bytes) -> bytes:
+    return _HEAD_MARKER + data_len.to_bytes(_HEAD_FILE_SIZE_BYTE_SIZE, byteorder='big') + iv
+
+
+# 从src读取明文，加密后写入dst，内存占用与文件大小无关，输出格式与encrypt_data相同。
+# length为None时从src推算，无法推算时dst必须支持seek，写完后回填长度。
+# framed为True时使用v3的流式格式，不需要知道长度，输入输出都可以是管道
+def encrypt_stream(key, src, dst, chunk_size: int = _STREAM_CHUNK_SIZE, length: int = None,
+                   version: int = FORMAT_V1, compression: int = COMPRESS_NONE, framed: bool = False) -> int:
+    _check_chunk_size(chunk_size)
+
+    if framed:
+        if version != FORMAT_V3:
+            raise ValueError('流式格式只支持v3')
+        return _encrypt_framed_stream(key, src, dst, chunk_size, compression)
+    if length is None:
+        length = _remaining_size(src)
+    if version != FORMAT_V1 or compression != COMPRESS_NONE:
+        return _encrypt_chunked_stream(key, src, dst, version, chunk_size, length, compression)
+    header_pos = None
+    if dst.seekable():
+        header_pos = dst.tell()
+    elif length is None:
+        raise InvalidEncryptDataException('无法确定数据长度')
+
+    iv = generate_iv()
+    cipher = AES.new(key, AES.MODE_CBC, iv)
+    dst.write(make_header(length or 0, iv))
+
+    total = 0
+    chunk = _read_full(src, chunk_size)
+    while True:
+        # 预读下一块，用于判断当前块是否需要填充
+        next_chunk = _read_full(src, chunk_size)
+        total += len(chunk)
+        if not next_chunk:
+            dst.write(cipher.encrypt(pad(chunk, AES.block_size, style='pkcs7')))
+            break
+        dst.write(cipher.encrypt(chunk))
+        chunk = next_chunk
+
+    if total != length:
+        if header_pos is None:
+            raise InvalidEncryptDataException('数据长度与声明的长度不一致')
+        end_pos = dst.tell()
+        dst.seek(header_pos + _HEAD_MARKER_BYTE_SIZE)
+        dst.write(total.to_bytes(_HEAD_FILE_SIZE_BYTE_SIZE, byteorder='big'))
+        dst.seek(end_pos)
+
+    return total
+
+
+# 从src读取encrypt_data/encrypt_stream格式的密文，解密后写入dst，返回明文长度
+def decrypt_stream(key, src, dst, chunk_size: int = _STREAM_CHUNK_SIZE) -> int:
+    _check_chunk_size(chunk_size)
+
+    marker = _read_full(src, _HEAD_MARKER_BYTE_SIZE)
+    version = get_format_version(marker)
+    if version is None:
+        raise InvalidEncryptDataException('不是有效的加密数据')
+    if version != FORMAT_V1:
+        return _decrypt_chunked_stream(key, marker, src, dst)
+
+    header = marker + _read_full(src, _HEAD_LENGTH - _HEAD_MARKER_BYTE_SIZE)
+    if len(header) < _HEAD_LENGTH:
+        raise InvalidEncryptDataException('不是有效的加密数据')
+
+    data_len, iv = parse_header(header)
+    cipher = AES.new(key, AES.MODE_CBC, iv)
+
+    remaining = data_len
+    while remaining > 0:
+        chunk = _read_full(src, chunk_size)
+        if len(chunk) % AES.block_size != 0:
+            raise InvalidEncryptDataException('加密数据不完整')
+        if not chunk:
+            break
+        raw_data = cipher.decrypt(chunk)
+        if len(raw_data) > remaining:
+            raw_data = raw_data[:remaining]
+        dst.write(raw_data)
+        remaining -= len(raw_data)
+
+    if remaining > 0:
+        raise InvalidEncryptDataException('加密数据不完整')
+
+    return data_len
+
+
+def encrypted_size(data_len: int) -> int:
+    # pkcs7填充总会增加1到16个字节
+    return _HEAD_LENGTH + (data_len // AES.block_size + 1) * AES.block_size
+
+
+# 把encrypt_data格式的数据直接写入调用方提供的可写缓冲区，返回写入的字节数
+def encrypt_into(key, raw_data, out) -> int:
+    raw_view = memoryview(raw_data).cast('B')
+    out_view = memoryview(out).cast('B')
+    data_len = len(raw_view)
+    total = encrypted_size(data_len)
+    if len(out_view) < total:
+        raise ValueError('输出缓冲区太小，需要{}字节'.format(total))
+
+    iv = generate_iv()
+    out_view[:_HEAD_LENGTH] = make_header(data_len, iv)
+
+    cipher = AES.new(key, AES.MODE_CBC, iv)
+    aligned_len = data_len - data_len % AES.block_size
+    if aligned_len > 0:
+        cipher.encrypt(raw_view[:aligned_len], output=out_view[_HEAD_LENGTH:_HEAD_LENGTH + aligned_len])
+    # 只有最后不足一块的数据需要复制出来填充
+    last_block = pad(bytes(raw_view[aligned_len:]), AES.block_size, style='pkcs7')
+    cipher.encrypt(last_block, output=out_view[_HEAD_LENGTH + aligned_len:total])
+    return total
+
+
+# 把encrypt_data格式的数据解密到调用方提供的可写缓冲区，返回明文长度
+def decrypt_into(key, enc_data, out) -> int:
+    enc_view = memoryview(enc_data).cast('B')
+    out_view = memoryview(out).cast('B')
+    version = get_format_version(enc_view)
+    if version is None:
+        raise InvalidEncryptDataException('不是有效的加密数据')
+    if version != FORMAT_V1:
+        return _decrypt_chunked_into(key, enc_view, out_view)
+    if len(enc_view) < _HEAD_LENGTH:
+        raise InvalidEncryptDataException('不是有效的加密数据')
+
+    data_len, iv = parse_header(enc_view)
+    if len(out_view) < data_len:
+        raise ValueError('输出缓冲区太小，需要{}字节'.format(data_len))
+    if len(enc_view) < _HEAD_LENGTH + data_len:
+        raise InvalidEncryptDataException('加密数据不完整')
+
+    cipher = AES.new(key, AES.MODE_CBC, bytes(iv))
+    aligned_len = data_len - data_len % AES.block_size
+    if aligned_len > 0:
+        cipher.decrypt(enc_view[_HEAD_LENGTH:_HEAD_LENGTH + aligned_len], output=out_view[:aligned_len])
+    tail_len = data_len - aligned_len
+    if tail_len > 0:
+        block_start = _HEAD_LENGTH + aligned_len
+        last_block = cipher.decrypt(enc_view[block_start:block_start + AES.block_size])
+        out_view[aligned_len:data_len] = last_block[:tail_len]
+    return data_len
+
+
+class BufferPool:
+
+    # 缓冲区按granularity向上取整，尺寸相近的文件可以复用同一个缓冲区
+    def __init__(self, max_buffers: int = 8, granularity: int = 64 * 1024):
+        self._buffers: List[bytearray] = []
+        self._max_buffers = max_buffers
+        self._granularity = granularity
+        self._lock = threading.Lock()
+
+    def acquire(self, size: int) -> bytearray:
+        with self._lock:
+            for idx, buffer in enumerate(self._buffers):
+                if len(buffer) >= size:
+                    return self._buffers.pop(idx)
+        capacity = -(-max(size, 1) // self._granularity) * self._granularity
+        return bytearray(capacity)
+
+    def release(self, buffer: bytearray):
+        with self._lock:
+            if len(self._buffers) < self._max_buffers:
+                self._buffers.append(buffer)
+                return
+            # 池满时替换掉最小的缓冲区
+            smallest = min(range(len(self._buffers)), key=lambda i: len(self._buffers[i]))
+            if len(self._buffers[smallest]) < len(buffer):
+                self._buffers[smallest] = buffer
+
+    @contextmanager
+    def buffer(self, size: int):
+        buffer = self.acquire(size)
+        view = memoryview(buffer)[:size]
+        try:
+            yield view
+        finally:
+            view.release()
+            self.release(buffer)
+
+
+def encrypt_file_pooled(key, src_path: str, dst_path: str, pool: BufferPool, sync_group: SyncGroup = None) -> int:
+    data_len = os.path.getsize(src_path)
+    with pool.buffer(data_len) as raw_view, pool.buffer(encrypted_size(data_len)) as enc_view:
+        with open(src_path, 'rb') as f:
+            data_len = f.readinto(raw_view)
+        length = encrypt_into(key, raw_view[:data_len], enc_view)
+        with atomic_open(dst_path, length, sync_group) as f:
+            f.write(enc_view[:length])
+    return data_len
+
+
+def decrypt_file_pooled(key, src_path: str, dst_path: str, pool: BufferPool, sync_group: SyncGroup = None) -> int:
+    enc_len = os.path.getsize(src_path)
+    data_len = _pooled_plain_size(src_path, enc_len)
+    if data_len is None:
+        # 流式格式或者头部的长度不可信，不知道明文有多大，使用不需要整块缓冲区的解密
+        return decrypt_file(key, src_path, dst_path, sync_group=sync_group)
+    with pool.buffer(enc_len) as enc_view, pool.buffer(data_len) as raw_view:
+        with open(src_path, 'rb') as f:
+            enc_len = f.readinto(enc_view)
+        data_len = decrypt_into(key, enc_view[:enc_len], raw_view)
+        with atomic_open(dst_path, data_len, sync_group) as f:
+            f.write(raw_view[:data_len])
+    return data_len
+
+
+# workers大于1且使用分块格式时多线程并行加密，v1格式的CBC只能串行。
+# 输出先写临时文件再改名，sync_group不为None时由它统一fsync和改名
+def encrypt_file(key, src_path: str, dst_path: str, chunk_size: int = _STREAM_CHUNK_SIZE,
+                 version: int = FORMAT_V1, workers: int = 1, compression: int = COMPRESS_NONE,
+                 sync_group: SyncGroup = None) -> int:
+    if version != FORMAT_V1 and (workers is None or workers > 1):
+        processor = partial(_encrypt_chunked_parallel, version=version, workers=workers, compression=compression)
+    else:
+        processor = partial(encrypt_stream, version=version, compression=compression)
+    output_size = encrypted_file_size(os.path.getsize(src_path), version, chunk_size, compression)
+    return _process_file(processor, key, src_path, dst_path, chunk_size, output_size, sync_group)
+
+
+def decrypt_file(key, src_path: str, dst_path: str, chunk_size: int = _STREAM_CHUNK_SIZE,
+                 use_mmap: bool = True, sync_group: SyncGroup = None) -> int:
+    processor = _decrypt_mmap_file if use_mmap else decrypt_stream
+    return _process_file(processor, key, src_path, dst_path, chunk_size, _decrypted_size_from_header(src_path),
+                         sync_group)
+
+
+# 加密后的文件大小，启用压缩时无法预先确定，返回None
+def encrypted_file_size(data_len: int, version: int = FORMAT_V1, chunk_size: int = _STREAM_CHUNK_SIZE,
+                        compression: int = COMPRESS_NONE):
+    if compression != COMPRESS_NONE:
+        return None
+    if version == FORMAT_V1:
+        return encrypted_size(data_len)
+    header = ChunkedHeader(version, data_len, chunk_size, COMPRESS_NONE, bytes(_CHUNK_NONCE_BYTE_SIZE))
+    return _fixed_offsets(header)[-1]
+
+
+def _pooled_plain_size(src_path: str, enc_len: int):
+    # 明文缓冲区按头部记录的长度分配，压缩的数据明文可能比密文大
+    with open(src_path, 'rb') as f:
+        header = f.read(_CHUNKED_HEAD_LENGTH)
+    version = get_format_version(header)
+    if version is None:
+        raise InvalidEncryptDataException('不是有效的加密数据')
+    if version == FORMAT_V1:
+        if len(header) < _HEAD_LENGTH:
+            raise InvalidEncryptDataException('不是有效的加密数据')
+        data_len, _ = parse_header(header)
+        return data_len if data_len <= enc_len else None
+    chunked_header = parse_chunked_header(header)
+    if chunked_header.framed:
+        return None
+    if chunked_header.compression == COMPRESS_NONE and chunked_header.data_len > enc_len:
+        return None
+    return chunked_header.data_len
+
+
+def _decrypted_size_from_header(src_path: str):
+    # 所有格式的明文长度都紧跟在marker后面
+    with open(src_path, 'rb') as f:
+        header = f.read(_HEAD_MARKER_BYTE_SIZE + _HEAD_FILE_SIZE_BYTE_SIZE)
+        enc_len = os.fstat(f.fileno()).st_size
+    if get_format_version(header) is None or len(header) < _HEAD_MARKER_BYTE_SIZE + _HEAD_FILE_SIZE_BYTE_SIZE:
+        return None
+    data_len = int.from_bytes(header[_HEAD_MARKER_BYTE_SIZE:], byteorder='big')
+    # 压缩的数据或者损坏的头部，不按头部的长度预分配
+    return data_len if data_len <= enc_len else None
+
+
+# 用mmap映射密文文件解密，数据由页缓存提供而不是读入python堆。
+# 明文写入dst文件对象，或者直接解密到out缓冲区
+def decrypt_mmap(key, src_path: str, dst=None, out=None, chunk_size: int = _STREAM_CHUNK_SIZE) -> int:
+    if (dst is None) == (out is None):
+        raise ValueError('dst和out必须且只能指定一个')
+    with open(src_path, 'rb') as src:
+        return _decrypt_mmap_file(key, src, dst, chunk_size, out)
+
+
+class _NullWriter:
+
+    def write(self, data):
+        return len(data)
+
+
+# 完整解密一遍但不输出，检查文件是否损坏或者密钥是否正确。
+# 只有v3格式带有校验信息，返回True；v1格式额外检查最后一块的填充，能发现大部分密钥错误；
+# v2格式只能检查结构，返回False
+def verify_file(key, src_path: str, chunk_size: int = _STREAM_CHUNK_SIZE) -> bool:
+    with open(src_path, 'rb') as src:
+        _decrypt_mmap_file(key, src, _NullWriter(), chunk_size)
+        src.seek(0)
+        header = _read_full(src, _HEAD_LENGTH)
+        version = get_format_version(header)
+        if version != FORMAT_V1:
+            return version == FORMAT_V3
+
+        data_len, _ = parse_header(header)
+        last_pos = _HEAD_LENGTH + _aligned_size(data_len + 1) - AES.block_size
+        # 头部以IV结尾，只有一块时前一块就是IV
+        src.seek(last_pos - AES.block_size)
+        blocks = _read_full(src, AES.block_size * 2)
+    if len(blocks) != AES.block_size * 2:
+        raise InvalidEncryptDataException('加密数据不完整')
+    last_block = AES.new(key, AES.MODE_CBC, bytes(blocks[:AES.block_size])).decrypt(bytes(blocks[AES.block_size:]))
+    try:
+        unpad(last_block, AES.block_size, style='pkcs7')
+    except ValueError:
+        raise InvalidEncryptDataException('填充错误，密钥不正确或者数据已损坏')
     return False
 
 
+def _decrypt_mmap_file(key, src, dst, chunk_size: int, out=None) -> int:
+    _check_chunk_size(chunk_size)
+    if os.fstat(src.fileno()).st_size < _HEAD_LENGTH:
+        raise InvalidEncryptDataException('不是有效的加密数据')
+
+    mm = mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        if hasattr(mm, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        view = memoryview(mm)
+        try:
+            if out is not None:
+                return decrypt_into(key, view, out)
+            return _decrypt_view(key, view, dst, chunk_size)
+        finally:
+            view.release()
+    finally:
+        try:
+            mm.close()
+        except BufferError:
+            # 解密出错时异常的traceback还引用着块的切片，异常处理完后由垃圾回收释放映射
+            pass
+
+
+def _decrypt_view(key, view: memoryview, dst, chunk_size: int) -> int:
+    version = get_format_version(view)
+    if version is None:
+        raise InvalidEncryptDataException('不是有效的加密数据')
+    if version != FORMAT_V1:
+        data_len = 0
+        for raw_data in _iter_chunked_view(key, view):
+            dst.write(raw_data)
+            data_len += len(raw_data)
+        return data_len
+
+    data_len, iv = parse_header(view)
+    cipher = AES.new(key, AES.MODE_CBC, bytes(iv))
+
+    buffer = memoryview(bytearray(min(chunk_size, _aligned_size(data_len))))
+    pos = _HEAD_LENGTH
+    remaining = data_len
+    while remaining > 0:
+        size = min(len(buffer), _aligned_size(remaining))
+        if pos + size > len(view):
+            raise InvalidEncryptDataException('加密数据不完整')
+        cipher.decrypt(view[pos:pos + size], output=buffer[:size])
+        write_size = min(size, remaining)
+        dst.write(buffer[:write_size])
+        pos += size
+        remaining -= write_size
+
+    return data_len
+
+
+def _aligned_size(length: int) -> int:
+    return -(-length // AES.block_size) * AES.block_size
+
+
+def _process_file(processor, key, src_path, dst_path, chunk_size, output_size=None, sync_group=None):
+    # 输出总是先写临时文件，输入输出是同一个文件时也不会边读边截断
+    with open(src_path, 'rb') as src, atomic_open(dst_path, output_size, sync_group) as dst:
+        return processor(key, src, dst, chunk_size)
+
+
+def _check_chunk_size(chunk_size: int):
+    if chunk_size <= 0 or chunk_size % AES.block_size != 0:
+        raise ValueError('chunk_size必须是{}的正整数倍'.format(AES.block_size))
+
+
+def _remaining_size(src):
+    try:
+        return os.fstat(src.fileno()).st_size - src.tell()
+    except (AttributeError, OSError, io.UnsupportedOperation):
+        pass
+    if src.seekable():
+        pos = src.tell()
+        end = src.seek(0, io.SEEK_END)
+        src.seek(pos)
+        return end - pos
+    return None
+
+
+def _read_full(src, size: int):
+    # 管道等输入可能一次读不满，CBC要求中间的块必须对齐
+    data = src.read(size)
+    if not data or len(data) == size:
+        return data
+    buffer = bytearray(data)
+    while len(buffer) < size:
+        more = src.read(size - len(buffer))
+        if not more:
+            break
+        buffer.extend(more)
+    return buffer
+
+
+# 分块格式（v2）：
+# | marker 16 | 明文长度 128 | 块大小 4 | flags 4 | nonce 8 | 索引 (块数 + 1) * 8 | 块 ... |
+# 索引记录每个块在文件中的起始位置，最后一项是结束位置；
+# 每个块独立使用AES-CTR加密，nonce为头部的nonce加上4字节块序号，随机读取时只需解密涉及的块。
+# v3与v2布局相同，块改用AES-GCM加密，头部作为附加认证数据，每块密文后跟16字节标签，
+# 加密和校验一次完成，解密时每块校验通过后才输出。
+# 启用压缩时每块先单独压缩再加密，块的长度不再固定，需要通过索引定位
+
+class Compressor(NamedTuple):
+    name: str
+    compress: Callable[[bytes], bytes]
+    # decompress(data, max_length)，最多返回max_length字节，防止损坏的数据耗尽内存
+    decompress: Callable[[bytes, int], bytes]
+
+
+_COMPRESSORS: Dict[int, Compressor] = {
+    COMPRESS_ZLIB: Compressor('zlib', zlib.compress,
+                              lambda data, max_length: zlib.decompressobj().decompress(data, max_length)),
+    COMPRESS_BZ2: Compressor('bz2', bz2.compress,
+                             lambda data, max_length: bz2.BZ2Decompressor().decompress(data, max_length)),
+    COMPRESS_LZMA: Compressor('lzma', lzma.compress,
+                              lambda data, max_length: lzma.LZMADecompressor().decompress(data, max_length)),
+}
+
+
+def register_compressor(compress_id: int, name: str,
+                        compress: Callable[[bytes], bytes],
+                        decompress: Callable[[bytes, int], bytes]):
+    if compress_id <= COMPRESS_NONE or compress_id > _COMPRESSION_MASK:
+        raise ValueError('压缩算法id必须在1到{}之间'.format(_COMPRESSION_MASK))
+    _COMPRESSORS[compress_id] = Compressor(name, compress, decompress)
+
+
+def get_compressor(compress_id: int) -> Compressor:
+    compressor = _COMPRESSORS.get(compress_id)
+    if compressor is None:
+        raise InvalidEncryptDataException('不支持的压缩算法：{}'.format(compress_id))
+    return compressor
+
+
+class ChunkedHeader(NamedTuple):
+    version: int
+    data_len: int
+    chunk_size: int
+    flags: int
+    nonce: bytes
+
+    @property
+    def chunk_count(self) -> int:
+        return -(-self.data_len // self.chunk_size)
+
+    @property
+    def data_offset(self) -> int:
+        return _CHUNKED_HEAD_LENGTH + (self.chunk_count + 1) * _CHUNK_INDEX_ENTRY_SIZE
+
+    @property
+    def compression(self) -> int:
+        return self.flags & _COMPRESSION_MASK
+
+    @property
+    def framed(self) -> bool:
+        return bool(self.flags & _FLAG_FRAMED)
+
+    def chunk_data_len(self, idx: int) -> int:
+        return min(self.chunk_size, self.data_len - idx * self.chunk_size)
+
+    def to_bytes(self) -> bytes:
+        marker = next(m for m, v in _HEAD_MARKERS.items() if v == self.version)
+        return b''.join((
+            marker,
+            self.data_len.to_bytes(_HEAD_FILE_SIZE_BYTE_SIZE, byteorder='big'),
+            self.chunk_size.to_bytes(_CHUNK_SIZE_BYTE_SIZE, byteorder='big'),
+            self.flags.to_bytes(_CHUNK_FLAGS_BYTE_SIZE, byteorder='big'),
+            self.nonce,
+        ))
+
+
+def parse_chunked_header(enc_data) -> ChunkedHeader:
+    if len(enc_data) < _CHUNKED_HEAD_LENGTH:
+        raise InvalidEncryptDataException('不是有效的加密数据')
+    version = get_format_version(enc_data)
+    if version is None or version == FORMAT_V1:
+        raise InvalidEncryptDataException('不是分块格式的加密数据')
+
+    pos = _HEAD_MARKER_BYTE_SIZE
+    fields = []
+    for size in (_HEAD_FILE_SIZE_BYTE_SIZE, _CHUNK_SIZE_BYTE_SIZE, _CHUNK_FLAGS_BYTE_SIZE):
+        fields.append(int.from_bytes(enc_data[pos:pos + size], byteorder='big'))
+        pos += size
+    nonce = bytes(enc_data[pos:pos + _CHUNK_NONCE_BYTE_SIZE])
+
+    header = ChunkedHeader(version, fields[0], fields[1], fields[2], nonce)
+    if header.chunk_size == 0 or header.chunk_count >= 1 << 32:
+        raise InvalidEncryptDataException('不是有效的加密数据')
+    if header.flags & ~(_COMPRESSION_MASK | _FLAG_FRAMED) or (header.framed and version != FORMAT_V3):
+        raise InvalidEncryptDataException('不支持的flags：{}'.format(header.flags))
+    if header.compression != COMPRESS_NONE:
+        get_compressor(header.compression)
+    return header
+
+
+# 从src的当前位置读取分块格式的[offset, offset + size)范围，只解密涉及的块，src必须支持seek
+def decrypt_range(key, src, offset: int, size: int) -> bytes:
+    if offset < 0 or size < 0:
+        raise ValueError('offset和size不能为负数')
+
+    base = src.tell()
+    header = parse_chunked_header(_read_full(src, _CHUNKED_HEAD_LENGTH))
+    if header.framed:
+        raise InvalidEncryptDataException('流式格式不支持随机读取')
+
+    end = min(offset + size, header.data_len)
+    if offset >= end:
+        return b''
+
+    first = offset // header.chunk_size
+    last = (end - 1) // header.chunk_size
+    src.seek(base + _CHUNKED_HEAD_LENGTH + first * _CHUNK_INDEX_ENTRY_SIZE)
+    offsets = _parse_index(_read_full(src, (last - first + 2) * _CHUNK_INDEX_ENTRY_SIZE), last - first + 1)
+
+    parts = []
+    for idx in range(first, last + 1):
+        chunk_start, chunk_end = offsets[idx - first], offsets[idx - first + 1]
+        src.seek(base + chunk_start)
+        enc_chunk = _read_full(src, chunk_end - chunk_start)
+        parts.append(_decrypt_chunk(key, header, idx, enc_chunk))
+
+    skip = offset - first * header.chunk_size
+    return b''.join(parts)[skip:skip + end - offset]
+
+
+def _chunk_cipher(key, header: ChunkedHeader, idx: int):
+    nonce = header.nonce + idx.to_bytes(4, byteorder='big')
+    if header.version == FORMAT_V3:
+        cipher = AES.new(key, AES.MODE_GCM, nonce=nonce)
+        cipher.update(header.to_bytes())
+        return cipher
+    return AES.new(key, AES.MODE_CTR, nonce=nonce)
+
+
+# 压缩后块的长度不固定，返回None
+def _chunk_enc_size(header: ChunkedHeader, idx: int):
+    if header.compression != COMPRESS_NONE:
+        return None
+    if header.version == FORMAT_V3:
+        return header.chunk_data_len(idx) + _CHUNK_TAG_BYTE_SIZE
+    return header.chunk_data_len(idx)
+
+
+def _encrypt_chunk(key, header: ChunkedHeader, idx: int, raw_chunk) -> bytes:
+    if header.compression != COMPRESS_NONE:
+        raw_chunk = get_compressor(header.compression).compress(bytes(raw_chunk))
+    cipher = _chunk_cipher(key, header, idx)
+    if header.version == FORMAT_V3:
+        enc_chunk, tag = cipher.encrypt_and_digest(raw_chunk)
+        return enc_chunk + tag
+    return cipher.encrypt(raw_chunk)
+
+
+def _decrypt_chunk(key, header: ChunkedHeader, idx: int, enc_chunk, output=None):
+    enc_size = _chunk_enc_size(header, idx)
+    if enc_size is not None and len(enc_chunk) != enc_size:
+        raise InvalidEncryptDataException('加密数据不完整')
+    if header.version == FORMAT_V3 and len(enc_chunk) < _CHUNK_TAG_BYTE_SIZE:
+        raise InvalidEncryptDataException('加密数据不完整')
+
+    if header.compression == COMPRESS_NONE:
+        return _decrypt_chunk_data(key, header, idx, enc_chunk, output)
+
+    data_len = header.chunk_data_len(idx)
+    compressed = _decrypt_chunk_data(key, header, idx, enc_chunk)
+    try:
+        raw_chunk = get_compressor(header.compression).decompress(compressed, data_len + 1)
+    except (zlib.error, OSError, lzma.LZMAError, EOFError) as e:
+        raise InvalidEncryptDataException('第{}块解压失败：{}'.format(idx, e))
+    if len(raw_chunk) != data_len:
+        raise InvalidEncryptDataException('第{}块解压后的长度不正确'.format(idx))
+    if output is None:
+        return raw_chunk
+    output[:] = raw_chunk
+
+
+def _decrypt_chunk_data(key, header: ChunkedHeader, idx: int, enc_chunk, output=None):
+    cipher = _chunk_cipher(key, header, idx)
+    if header.version == FORMAT_V3:
+        tag_pos = len(enc_chunk) - _CHUNK_TAG_BYTE_SIZE
+        try:
+            return cipher.decrypt_and_verify(enc_chunk[:tag_pos], enc_chunk[tag_pos:], output=output)
+        except ValueError:
+            raise InvalidEncryptDataException('数据校验失败，第{}块已损坏或被篡改'.format(idx))
+    return cipher.decrypt(enc_chunk, output=output)
+
+
+def _new_chunked_header(version: int, data_len: int, chunk_size: int,
+                        compression: int = COMPRESS_NONE) -> ChunkedHeader:
+    if version not in _HEAD_MARKERS.values() or version == FORMAT_V1:
+        raise ValueError('{}格式不支持分块或压缩'.format(version))
+    _check_chunk_size(chunk_size)
+    if compression != COMPRESS_NONE:
+        get_compressor(compression)
+    header = ChunkedHeader(version, data_len, chunk_size, compression, Random.new().read(_CHUNK_NONCE_BYTE_SIZE))
+    if header.chunk_count >= 1 << 32:
+        raise ValueError('数据太大，请增大chunk_size')
+    return header
+
+
+def _index_bytes(offsets: List[int]) -> bytes:
+    return struct.pack('>{}Q'.format(len(offsets)), *offsets)
+
+
+def _parse_index(index_data, chunk_count: int) -> List[int]:
+    if len(index_data) != (chunk_count + 1) * _CHUNK_INDEX_ENTRY_SIZE:
+        raise InvalidEncryptDataException('加密数据不完整')
+    offsets = struct.unpack('>{}Q'.format(chunk_count + 1), index_data)
+    for start, end in zip(offsets, offsets[1:]):
+        if end < start:
+            raise InvalidEncryptDataException('块索引损坏')
+    return list(offsets)
+
+
+def _fixed_offsets(header: ChunkedHeader) -> List[int]:
+    offsets = [header.data_offset]
+    for idx in range(header.chunk_count):
+        offsets.append(offsets[-1] + _chunk_enc_size(header, idx))
+    return offsets
+
+
+def _encrypt_chunked(key, raw_data, version: int, chunk_size: int, compression: int = COMPRESS_NONE) -> bytes:
+    raw_view = memoryview(raw_data).cast('B')
+    header = _new_chunked_header(version, len(raw_view), chunk_size, compression)
+    chunks = []
+    offsets = [header.data_offset]
+    for idx in range(header.chunk_count):
+        start = idx * chunk_size
+        chunks.append(_encrypt_chunk(key, header, idx, raw_view[start:start + chunk_size]))
+        offsets.append(offsets[-1] + len(chunks[-1]))
+    return b''.join([header.to_bytes(), _index_bytes(offsets)] + chunks)
+
+
+def _encrypt_chunked_stream(key, src, dst, version: int, chunk_size: int, length: int,
+                            compression: int = COMPRESS_NONE) -> int:
+    if length is None:
+        raise InvalidEncryptDataException('无法确定数据长度')
+
+    header = _new_chunked_header(version, length, chunk_size, compression)
+    fixed_size = compression == COMPRESS_NONE
+    if not fixed_size and not dst.seekable():
+        raise InvalidEncryptDataException('启用压缩时输出必须支持seek')
+
+    header_pos = dst.tell() if dst.seekable() else 0
+    dst.write(header.to_bytes())
+    # 块长度不固定时先占位，写完所有块后回填索引
+    offsets = _fixed_offsets(header) if fixed_size else [header.data_offset]
+    dst.write(_index_bytes(offsets) if fixed_size else bytes(header.data_offset - _CHUNKED_HEAD_LENGTH))
+
+    for idx in range(header.chunk_count):
+        raw_chunk = _read_full(src, header.chunk_data_len(idx))
+        if len(raw_chunk) != header.chunk_data_len(idx):
+            raise InvalidEncryptDataException('数据长度与声明的长度不一致')
+        enc_chunk = _encrypt_chunk(key, header, idx, raw_chunk)
+        dst.write(enc_chunk)
+        if not fixed_size:
+            offsets.append(offsets[-1] + len(enc_chunk))
+
+    if src.read(1):
+        raise InvalidEncryptDataException('数据长度与声明的长度不一致')
+
+    if not fixed_size:
+        end_pos = dst.tell()
+        dst.seek(header_pos + _CHUNKED_HEAD_LENGTH)
+        dst.write(_index_bytes(offsets))
+        dst.seek(end_pos)
+    return length
+
+
+# 未压缩时每个块的位置在加密前就能算出来，各线程用pread/pwrite按位置读写，互不等待。
+# 压缩时块长度不固定，各线程并行压缩加密，再按顺序写出。
+# pycryptodome和zlib等压缩库处理数据时会释放GIL，线程池就能用满多核
+def _encrypt_chunked_parallel(key, src, dst, chunk_size: int, version: int, workers: int = None,
+                              compression: int = COMPRESS_NONE) -> int:
+    src_fd, dst_fd = src.fileno(), dst.fileno()
+    src_base = src.tell()
+    length = os.fstat(src_fd).st_size - src_base
+
+    header = _new_chunked_header(version, length, chunk_size, compression)
+    fixed_size = compression == COMPRESS_NONE
+    offsets = _fixed_offsets(header) if fixed_size else [header.data_offset]
+    _pwrite_full(dst_fd, header.to_bytes(), 0)
+    if fixed_size:
+        _pwrite_full(dst_fd, _index_bytes(offsets), _CHUNKED_HEAD_LENGTH)
+        os.ftruncate(dst_fd, offsets[-1])
+
+    def encrypt_chunk(idx):
+        raw_chunk = _pread_full(src_fd, header.chunk_data_len(idx), src_base + idx * chunk_size)
+        if len(raw_chunk) != header.chunk_data_len(idx):
+            raise InvalidEncryptDataException('数据长度与声明的长度不一致')
+        enc_chunk = _encrypt_chunk(key, header, idx, raw_chunk)
+        if not fixed_size:
+            return enc_chunk
+        _pwrite_full(dst_fd, enc_chunk, offsets[idx])
+
+    workers = workers or os.cpu_count() or 1
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        try:
+            for idx in range(header.chunk_count):
+                pending.append(executor.submit(encrypt_chunk, idx))
+                # 限制在途的块数，压缩时内存占用不会随文件大小增长
+                if len(pending) >= workers * 2:
+                    _write_ordered_chunk(dst_fd, pending.popleft().result(), offsets)
+            while pending:
+                _write_ordered_chunk(dst_fd, pending.popleft().result(), offsets)
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+
+    if not fixed_size:
+        _pwrite_full(dst_fd, _index_bytes(offsets), _CHUNKED_HEAD_LENGTH)
+    return length
+
+
+def _write_ordered_chunk(fd, enc_chunk, offsets: List[int]):
+    if enc_chunk is None:
+        return
+    _pwrite_full(fd, enc_chunk, offsets[-1])
+    offsets.append(offsets[-1] + len(enc_chunk))
+
+
+if hasattr(os, 'pwrite'):
+
+    def _pread(fd, size, offset):
+        return os.pread(fd, size, offset)
+
+    def _pwrite(fd, data, offset):
+        return os.pwrite(fd, data, offset)
+
+else:
+    # windows没有pread/pwrite，用锁保护seek和读写
+    _positional_io_lock = threading.Lock()
+
+    def _pread(fd, size, offset):
+        with _positional_io_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, size)
+
+    def _pwrite(fd, data, offset):
+        with _positional_io_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.write(fd, data)
+
+
+def _pread_full(fd, size: int, offset: int):
+    data = _pread(fd, size, offset)
+    if not data or len(data) == size:
+        return data
+    buffer = bytearray(data)
+    while len(buffer) < size:
+        more = _pread(fd, size - len(buffer), offset + len(buffer))
+        if not more:
+            break
+        buffer.extend(more)
+    return buffer
+
+
+def _pwrite_full(fd, data, offset: int):
+    view = memoryview(data)
+    while view:
+        written = _pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def _decrypt_chunked_stream(key, marker: bytes, src, dst) -> int:
+    header = parse_chunked_header(marker + _read_full(src, _CHUNKED_HEAD_LENGTH - _HEAD_MARKER_BYTE_SIZE))
+    if header.framed:
+        data_len = 0
+        for raw_chunk in _iter_frames(key, header, partial(_read_full, src)):
+            dst.write(raw_chunk)
+            data_len += len(raw_chunk)
+        return data_len
+
+    index_len = (header.chunk_count + 1) * _CHUNK_INDEX_ENTRY_SIZE
+    offsets = _parse_index(_read_full(src, index_len), header.chunk_count)
+
+    pos = header.data_offset
+    for idx in range(header.chunk_count):
+        # 顺序读取时要求块是连续存放的
+        if offsets[idx] != pos:
+            raise InvalidEncryptDataException('块索引损坏')
+        enc_chunk = _read_full(src, offsets[idx + 1] - offsets[idx])
+        dst.write(_decrypt_chunk(key, header, idx, enc_chunk))
+        pos = offsets[idx + 1]
+    return header.data_len
+
+
+def _iter_chunked_view(key, view: memoryview):
+    header = parse_chunked_header(view)
+    if header.framed:
+        yield from _iter_frames(key, header, _ViewReader(view, _CHUNKED_HEAD_LENGTH).read)
+        return
+    index_view = view[_CHUNKED_HEAD_LENGTH:header.data_offset]
+    offsets = _parse_index(index_view, header.chunk_count)
+    if offsets[-1] > len(view):
+        raise InvalidEncryptDataException('加密数据不完整')
+    for idx in range(header.chunk_count):
+        yield _decrypt_chunk(key, header, idx, view[offsets[idx]:offsets[idx + 1]])
+
+
+def _decrypt_chunked_into(key, view: memoryview, out_view: memoryview) -> int:
+    header = parse_chunked_header(view)
+    if header.framed:
+        data_len = 0
+        for raw_chunk in _iter_frames(key, header, _ViewReader(view, _CHUNKED_HEAD_LENGTH).read):
+            if data_len + len(raw_chunk) > len(out_view):
+                raise ValueError('输出缓冲区太小')
+            out_view[data_len:data_len + len(raw_chunk)] = raw_chunk
+            data_len += len(raw_chunk)
+        return data_len
+    if len(out_view) < header.data_len:
+        raise ValueError('输出缓冲区太小，需要{}字节'.format(header.data_len))
+    offsets = _parse_index(view[_CHUNKED_HEAD_LENGTH:header.data_offset], header.chunk_count)
+    if offsets[-1] > len(view):
+        raise InvalidEncryptDataException('加密数据不完整')
+    for idx in range(header.chunk_count):
+        start = idx * header.chunk_size
+        _decrypt_chunk(key, header, idx, view[offsets[idx]:offsets[idx + 1]],
+                       output=out_view[start:start + header.chunk_data_len(idx)])
+    return header.data_len
+
+
+# v3流式格式：
+# | 头部，明文长度为0，flags带_FLAG_FRAMED | 块长度 4 | 块密文 + 标签 | 块长度 4 | ... |
+# 没有索引，只能顺序读取。块长度的最高位标记最后一块，除最后一块外每块明文都是chunk_size字节；
+# 附加认证数据是头部加上1字节的最后一块标记，截断或者修改标记都会导致校验失败
+def _encrypt_framed_stream(key, src, dst, chunk_size: int, compression: int = COMPRESS_NONE) -> int:
+    header = _new_framed_header(chunk_size, compression)
+    dst.write(header.to_bytes())
+
+    total = 0
+    idx = 0
+    chunk = _read_full(src, chunk_size)
+    while True:
+        # 预读下一块，用于判断当前块是否是最后一块
+        next_chunk = _read_full(src, chunk_size) if len(chunk) == chunk_size else b''
+        last = not next_chunk
+        dst.write(_frame_bytes(key, header, idx, chunk, last))
+        total += len(chunk)
+        if last:
+            return total
+        chunk = next_chunk
+        idx += 1
+
+
+def _new_framed_header(chunk_size: int, compression: int = COMPRESS_NONE) -> ChunkedHeader:
+    header = _new_chunked_header(FORMAT_V3, 0, chunk_size, compression)
+    header = header._replace(flags=header.flags | _FLAG_FRAMED)
+    if _max_frame_size(header) >= _FRAME_LAST:
+        raise ValueError('chunk_size太大')
+    return header
+
+
+# 返回带长度字段的一块
+def _frame_bytes(key, header: ChunkedHeader, idx: int, raw_chunk, last: bool) -> bytes:
+    if idx >= 1 << 32:
+        raise ValueError('数据太大，请增大chunk_size')
+    enc_chunk = _encrypt_frame(key, header, idx, raw_chunk, last)
+    frame_info = len(enc_chunk) | (_FRAME_LAST if last else 0)
+    return frame_info.to_bytes(_FRAME_LENGTH_BYTE_SIZE, byteorder='big') + enc_chunk
+
+
+def _frame_cipher(key, header: ChunkedHeader, idx: int, last: bool):
+    cipher = AES.new(key, AES.MODE_GCM, nonce=header.nonce + idx.to_bytes(4, byteorder='big'))
+    cipher.update(header.to_bytes() + (b'\x01' if last else b'\x00'))
+    return cipher
+
+
+def _encrypt_frame(key, header: ChunkedHeader, idx: int, raw_chunk, last: bool) -> bytes:
+    if header.compression != COMPRESS_NONE:
+        raw_chunk = get_compressor(header.compression).compress(bytes(raw_chunk))
+    enc_chunk, tag = _frame_cipher(key, header, idx, last).encrypt_and_digest(raw_chunk)
+    return enc_chunk + tag
+
+
+def _max_frame_size(header: ChunkedHeader) -> int:
+    # 压缩后的数据可能比原数据略大，这里只是防止损坏的长度字段导致一次读入过多数据
+    if header.compression == COMPRESS_NONE:
+        return header.chunk_size + _CHUNK_TAG_BYTE_SIZE
+    return header.chunk_size + header.chunk_size // 16 + 1024 + _CHUNK_TAG_BYTE_SIZE
+
+
+def _iter_frames(key, header: ChunkedHeader, read):
+    max_frame_size = _max_frame_size(header)
+    idx = 0
+    while True:
+        length_bytes = read(_FRAME_LENGTH_BYTE_SIZE)
+        if len(length_bytes) != _FRAME_LENGTH_BYTE_SIZE:
+            raise InvalidEncryptDataException('加密数据不完整')
+        frame_info = int.from_bytes(length_bytes, byteorder='big')
+        last = bool(frame_info & _FRAME_LAST)
+        frame_size = frame_info & ~_FRAME_LAST
+        if frame_size < _CHUNK_TAG_BYTE_SIZE or frame_size > max_frame_size:
+            raise InvalidEncryptDataException('第{}块的长度不正确'.format(idx))
+        enc_chunk = read(frame_size)
+        if len(enc_chunk) != frame_size:
+            raise InvalidEncryptDataException('加密数据不完整')
+
+        raw_chunk = _decrypt_frame(key, header, idx, enc_chunk, last)
+        if len(raw_chunk) > header.chunk_size or (not last and len(raw_chunk) != header.chunk_size):
+            raise InvalidEncryptDataException('第{}块的长度不正确'.format(idx))
+        yield raw_chunk
+
+        if last:
+            if read(1):
+                raise InvalidEncryptDataException('最后一块之后还有数据')
+            return
+        idx += 1
+
+
+def _decrypt_frame(key, header: ChunkedHeader, idx: int, enc_chunk, last: bool) -> bytes:
+    tag_pos = len(enc_chunk) - _CHUNK_TAG_BYTE_SIZE
+    try:
+        raw_chunk = _frame_cipher(key, header, idx, last).decrypt_and_verify(enc_chunk[:tag_pos],
+                                                                             enc_chunk[tag_pos:])
+    except ValueError:
+        raise InvalidEncryptDataException('数据校验失败，第{}块已损坏或被篡改'.format(idx))
+    if header.compression == COMPRESS_NONE:
+        return raw_chunk
+    try:
+        return get_compressor(header.compression).decompress(raw_chunk, header.chunk_size + 1)
+    except (zlib.error, OSError, lzma.LZMAError, EOFError) as e:
+        raise InvalidEncryptDataException('第{}块解压失败：{}'.format(idx, e))
+
+
+class _ViewReader:
+
+    # 从memoryview中按顺序读取，返回的是切片，不复制数据
+    def __init__(self, view: memoryview, pos: int = 0):
+        self._view = view
+        self._pos = pos
+
+    def read(self, size: int):
+        data = self._view[self._pos:self._pos + size]
+        self._pos += len(data)
+        return data
+
+
+def get_format_version(enc_data: bytes):
+    return _HEAD_MARKERS.get(bytes(enc_data[:_HEAD_MARKER_BYTE_SIZE]))
+
+
+def is_encrypt_data(enc_data: bytes):
+    return get_format_version(enc_data) is not None
+
+
 def not_encrypt_data(enc_data: bytes):
     return not is_encrypt_data(enc_data)
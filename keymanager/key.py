@@ -1,8 +1,13 @@
-from typing import List, Callable, TypeVar
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, List, Callable, Tuple, TypeVar
 import zipfile
 import os
 import time
 import hashlib
+import heapq
+import hmac
+import struct
 from io import BytesIO
 import threading
 
@@ -13,6 +18,20 @@ from keymanager.utils import write_file, read_file, read_header, get_md5_data_di
 
 _Key = TypeVar("KeyType", bound="Key")
 
+# 密钥文件v2格式，一次读入，不需要解压：
+# | marker 16 | flags 4 | id长度 2 | 名称长度 2 | 密钥长度 2 | 校验长度 2 | id | 名称 | 密钥 | 校验 |
+# 有密码时密钥用补全后的密码加密（encrypt_data的v1格式），校验是sha512(密码 + id)，和旧格式相同，
+# 旧文件不需要密码就能转换。旧格式是zip，有密码时整个zip再用空密码加密。
+# id和名称在固定头部之后，不需要解密，Key.peek只读取到名称为止
+_KEY_MARKER_V2 = b'KEY-V-0000000002'
+_KEY_HEAD_V2 = struct.Struct('>16sIHHHH')
+_KEY_FLAG_PASSWORD = 0x1
+
+KEY_FORMAT_V1 = 1
+KEY_FORMAT_V2 = 2
+# 新建密钥文件的权限，只有所有者可以读写；覆盖已有文件时保留原来的权限
+KEY_FILE_MODE = 0o600
+
 
 class Key:
 
@@ -22,19 +41,35 @@ class Key:
         self._key: bytes = None
         self.path: str = None
         self.md5: bytes = None
+        self.version = KEY_FORMAT_V2
         self._update_last_access()
 
         self._timeout = False
+        # 单独设置的超时时间（秒），None表示使用KEY_CHECKER['timeout']
+        self.expire_after: float = None
+        self._fingerprint: str = None
+        # peek得到的密钥只有id和名称，第一次访问key时才读取密钥文件
+        self._loaded = True
+        # 保护密钥内容和状态；超时检查线程和使用密钥的线程可能同时访问
+        self._lock = threading.RLock()
+        # 正在使用密钥的操作数，不为0时超时只做标记，等操作结束再清除密钥
+        self._users = 0
+        self._wipe_pending = False
 
     def copy(self) -> _Key:
         key = Key()
-        key.id = self.id
-        key.name = self.name
-        key._key = self._key
-        key.path = self.path
-        key.md5 = self.md5
+        with self._lock:
+            key.id = self.id
+            key.name = self.name
+            key._key = self._key
+            key.path = self.path
+            key.md5 = self.md5
+            key.version = self.version
+            key._fingerprint = self._fingerprint
+            key.expire_after = self.expire_after
+            key._loaded = self._loaded
+            key._timeout = self._timeout if not self._loaded else False
         key._update_last_access()
-        key._timeout = False
         return key
 
     def _update_last_access(self):
@@ -46,22 +81,68 @@ class Key:
 
     @timeout.setter
     def timeout(self, timeout):
-        if timeout:
-            self._key = None
-        self._timeout = timeout
+        with self._lock:
+            if timeout:
+                if self._users:
+                    self._wipe_pending = True
+                else:
+                    self._key = None
+            self._timeout = timeout
+
+    @property
+    def in_use(self) -> bool:
+        return self._users > 0
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    # 密钥内容的摘要，用来判断不同id的密钥是否相同。超时清除密钥后仍然保留，没有加载过的密钥为None
+    @property
+    def fingerprint(self):
+        return self._fingerprint
+
+    def _set_key_data(self, key: bytes):
+        self._key = key
+        if key is not None:
+            self._fingerprint = key_fingerprint(key)
 
     @property
     def key(self):
-        if not self._timeout:
+        with self._lock:
+            if self._timeout:
+                raise KeyTimeOutException()
+            if not self._loaded:
+                self.load(self.path)
             self._update_last_access()
             return self._key
-        raise KeyTimeOutException()
 
     @key.setter
     def key(self, key: bytes):
-        self._update_last_access()
-        self._timeout = False
-        self._key = key
+        with self._lock:
+            self._update_last_access()
+            self._timeout = False
+            self._wipe_pending = False
+            self._loaded = True
+            self._set_key_data(key)
+            _key_activated(self)
+
+    # 在操作期间占用密钥：with key.use() as raw_key: ...
+    # 占用期间不会因为超时被清除，超时检查把占用当作访问，结束后才重新计时
+    @contextmanager
+    def use(self):
+        with self._lock:
+            raw_key = self.key
+            self._users += 1
+        try:
+            yield raw_key
+        finally:
+            with self._lock:
+                self._users -= 1
+                self._update_last_access()
+                if self._users == 0 and self._wipe_pending:
+                    self._key = None
+                    self._wipe_pending = False
 
     @staticmethod
     def is_password_illegal(password: str):
@@ -80,81 +161,103 @@ class Key:
 
     @staticmethod
     def need_password(key_path):
-        marker_bytes = read_header(key_path)
-        return is_encrypt_data(marker_bytes)
+        header_bytes = read_header(key_path, _KEY_HEAD_V2.size)
+        if header_bytes[:len(_KEY_MARKER_V2)] == _KEY_MARKER_V2:
+            return bool(_unpack_key_v2_head(header_bytes)[1] & _KEY_FLAG_PASSWORD)
+        return is_encrypt_data(header_bytes)
+
+    # 只读取id、名称和格式版本，不解密密钥。没有密码的密钥在第一次访问key时自动加载；
+    # 有密码的密钥处于和超时相同的状态，需要用密码重新load
+    @staticmethod
+    def peek(key_path) -> _Key:
+        with open(key_path, 'rb') as f:
+            header_bytes = f.read(_KEY_HEAD_V2.size)
+            if header_bytes[:len(_KEY_MARKER_V2)] == _KEY_MARKER_V2:
+                _, flags, id_len, name_len, _, _ = _unpack_key_v2_head(header_bytes)
+                prefix = f.read(id_len + name_len)
+                if len(prefix) != id_len + name_len:
+                    raise InvalidKeyException('密钥文件不完整')
+                key_id = prefix[:id_len].decode('utf-8')
+                name = prefix[id_len:].decode('utf-8')
+                version = KEY_FORMAT_V2
+            else:
+                # 旧格式没有明文的前缀，只能解开整个文件
+                key_id, name, _, _, flags = _unpack_key_v1(header_bytes + f.read())
+                version = KEY_FORMAT_V1
+
+        key = Key()
+        key.id = key_id
+        key.name = name
+        key.path = key_path
+        key.version = version
+        key._loaded = False
+        key._timeout = bool(flags & _KEY_FLAG_PASSWORD)
+        return key
 
     def load(self, key_path, password: str = None):
+        with self._lock:
+            self._load(key_path, password)
+
+    def _load(self, key_path, password: str = None):
 
         self.path = key_path
 
         input_raw_bytes = read_file(self.path)
-        input_bytes = input_raw_bytes
-
-        self.md5 = hashlib.md5(input_bytes)
-
-        if password is not None:
+        self.md5 = hashlib.md5(input_raw_bytes).digest()
+
+        if input_raw_bytes[:len(_KEY_MARKER_V2)] == _KEY_MARKER_V2:
+            key_id, name, key_data, passwd, flags = _unpack_key_v2(input_raw_bytes)
+            self.version = KEY_FORMAT_V2
+        else:
+            key_id, name, key_data, passwd, flags = _unpack_key_v1(input_raw_bytes)
+            self.version = KEY_FORMAT_V1
+
+        # 密码校验用到id
+        self.id = key_id
+        self.name = name
+        if flags & _KEY_FLAG_PASSWORD:
+            if password is None:
+                raise InvalidPasswordException('密钥文件需要密码')
             illegal, msg = Key.is_password_illegal(password)
             if illegal:
                 raise InvalidKeyException(msg)
             password = self.pad_key(password)
-            blank_password = self.pad_key('')
-            # 整个文件用空密码解密
-            input_bytes = decrypt_data(blank_password, input_raw_bytes)
-
-        buffer = BytesIO(input_bytes)
-
-        with zipfile.ZipFile(buffer) as mem_zipfile:
-            self.id = mem_zipfile.read('id').decode('utf-8')
-            self.name = mem_zipfile.read('name').decode('utf-8')
-            self._key = mem_zipfile.read('key')
-            if password is not None:
-                password_b = self.sha_passwd(password)
-                if mem_zipfile.read('passwd').hex() != password_b.hex():
-                    raise InvalidPasswordException('密码错误')
-            if password is not None:
-                self._key = decrypt_data(password, self._key)
+            if not hmac.compare_digest(passwd, self.sha_passwd(password)):
+                raise InvalidPasswordException('密码错误')
+            key_data = decrypt_data(password, key_data)
 
+        self._set_key_data(key_data)
+        self._loaded = True
         self._update_last_access()
         self._timeout = False
+        self._wipe_pending = False
+        _key_activated(self)
 
     def save(self, key_path, password: str = None, calc_md5: bool = True):
-        self._update_last_access()
-        self.path = key_path
+        # 通过key取得密钥，peek得到的密钥会先加载，超时时抛出KeyTimeOutException，此时还没有修改任何状态
+        raw_key = self.key
 
-        passwd_md5 = None
         # 补全密码
+        flags = 0
+        key_data = raw_key
+        password_b = b''
         if password is not None:
             illegal, msg = Key.is_password_illegal(password)
             if illegal:
                 raise InvalidKeyException(msg)
             password = self.pad_key(password)
             password_b = self.sha_passwd(password)
-
-        # zip文件写入内存
-        buffer = BytesIO()
-        with zipfile.ZipFile(buffer, 'w') as mem_zipfile:
-            mem_zipfile.writestr('id', self.id.encode('utf-8'))
-            mem_zipfile.writestr('name', self.name.encode('utf-8'))
             # 使用密码加密key
-            key_data = self._key
-            if password is not None:
-                mem_zipfile.writestr('passwd', password_b)
-                key_data = encrypt_data(password, self._key)
-            mem_zipfile.writestr('key', key_data)
-
-        buffer.seek(0, 0)
-        output_bytes = buffer.read()
+            key_data = encrypt_data(password, raw_key)
+            flags |= _KEY_FLAG_PASSWORD
 
-        # 有密码的情况下使用空密码进行加密，作为标记
-        if password is not None:
-            blank_password = self.pad_key('')
-            output_bytes = encrypt_data(blank_password, output_bytes)
+        output_bytes = _pack_key_v2(self.id, self.name, key_data, password_b, flags)
 
+        # 写入文件，成功后才更新路径，懒加载的密钥仍然可以从原来的文件读取
+        write_file(key_path, output_bytes, mode=KEY_FILE_MODE)
+        self.path = key_path
         self.md5 = hashlib.md5(output_bytes).digest()
 
-        # 写入文件
-        write_file(key_path, output_bytes)
-
         if calc_md5:
             self.save_md5()
 
@@ -173,7 +276,7 @@ class Key:
 
     def is_key_modified(self):
         md5: bytes = self._load_md5()
-        if md5 is None:
+        if md5 is None or self.md5 is None:
             return None
         return not (md5.hex() == self.md5.hex())
 
@@ -189,6 +292,82 @@ class Key:
         return pad_key(password.encode('utf-8'))
 
 
+def key_fingerprint(key: bytes) -> str:
+    return hashlib.sha256(b'keymanager-fingerprint' + bytes(key)).hexdigest()[:32]
+
+
+def _unpack_key_v2_head(header_bytes: bytes):
+    if len(header_bytes) < _KEY_HEAD_V2.size:
+        raise InvalidKeyException('密钥文件不完整')
+    return _KEY_HEAD_V2.unpack_from(header_bytes)
+
+
+def _unpack_key_v2(input_bytes: bytes):
+    _, flags, id_len, name_len, key_len, passwd_len = _unpack_key_v2_head(input_bytes)
+    if len(input_bytes) != _KEY_HEAD_V2.size + id_len + name_len + key_len + passwd_len:
+        raise InvalidKeyException('密钥文件不完整')
+    pos = _KEY_HEAD_V2.size
+    fields = []
+    for length in (id_len, name_len, key_len, passwd_len):
+        fields.append(input_bytes[pos:pos + length])
+        pos += length
+    key_id, name, key_data, passwd = fields
+    return key_id.decode('utf-8'), name.decode('utf-8'), key_data, passwd, flags
+
+
+def _unpack_key_v1(input_bytes: bytes):
+    flags = 0
+    if is_encrypt_data(input_bytes):
+        # 整个文件用空密码解密
+        input_bytes = decrypt_data(pad_key(b''), input_bytes)
+        flags |= _KEY_FLAG_PASSWORD
+    try:
+        with zipfile.ZipFile(BytesIO(input_bytes)) as mem_zipfile:
+            key_id = mem_zipfile.read('id').decode('utf-8')
+            name = mem_zipfile.read('name').decode('utf-8')
+            key_data = mem_zipfile.read('key')
+            passwd = mem_zipfile.read('passwd') if flags & _KEY_FLAG_PASSWORD else b''
+    except (zipfile.BadZipFile, KeyError) as e:
+        raise InvalidKeyException('不是有效的密钥文件：{}'.format(e))
+    return key_id, name, key_data, passwd, flags
+
+
+def _pack_key_v2(key_id: str, name: str, key_data: bytes, passwd: bytes, flags: int) -> bytes:
+    id_b = key_id.encode('utf-8')
+    name_b = name.encode('utf-8')
+    for field in (id_b, name_b, key_data, passwd):
+        if len(field) > 0xFFFF:
+            raise InvalidKeyException('密钥名称太长')
+    head = _KEY_HEAD_V2.pack(_KEY_MARKER_V2, flags, len(id_b), len(name_b), len(key_data), len(passwd))
+    return b''.join((head, id_b, name_b, key_data, passwd))
+
+
+def get_key_file_version(key_path: str) -> int:
+    if read_header(key_path, len(_KEY_MARKER_V2)) == _KEY_MARKER_V2:
+        return KEY_FORMAT_V2
+    return KEY_FORMAT_V1
+
+
+# 把旧的zip格式密钥文件转换为v2格式，不需要密码：加密后的密钥和密码校验原样保留。
+# dst_path为None时原地转换，同时更新记录的md5。已经是v2格式时返回False
+def migrate_key_file(key_path: str, dst_path: str = None) -> bool:
+    input_bytes = read_file(key_path)
+    if input_bytes[:len(_KEY_MARKER_V2)] == _KEY_MARKER_V2:
+        return False
+
+    key_id, name, key_data, passwd, flags = _unpack_key_v1(input_bytes)
+    output_bytes = _pack_key_v2(key_id, name, key_data, passwd, flags)
+    write_file(key_path if dst_path is None else dst_path, output_bytes, mode=KEY_FILE_MODE)
+
+    if dst_path is None:
+        key = Key()
+        key.id = key_id
+        if key._load_md5() is not None:
+            key.md5 = hashlib.md5(output_bytes).digest()
+            key.save_md5()
+    return True
+
+
 class KeyTimeOutException(Exception):
     pass
 
@@ -201,11 +380,47 @@ class InvalidPasswordException(Exception):
     pass
 
 
+class KeyCacheSnapshot:
+
+    # 某一时刻缓存内容的只读视图，创建后不再修改，读取时不需要加锁
+    def __init__(self, version: int, by_id: Dict[str, Key], by_name: Dict[str, Tuple[Key, ...]],
+                 by_fingerprint: Dict[str, Key], current_key: Key):
+        self.version = version
+        self.current_key = current_key
+        self.keys: Tuple[Key, ...] = tuple(by_id.values())
+        self._by_id = by_id
+        self._by_name = by_name
+        self._by_fingerprint = by_fingerprint
+
+    def get(self, key_id: str, default: Key = None) -> Key:
+        return self._by_id.get(key_id, default)
+
+    def __contains__(self, key_id: str):
+        return key_id in self._by_id
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def get_by_name(self, name: str) -> Tuple[Key, ...]:
+        return self._by_name.get(name, ())
+
+    def find_by_fingerprint(self, fingerprint: str) -> Key:
+        return self._by_fingerprint.get(fingerprint)
+
+
 class KeyCache:
 
+    # 按id索引，保持加入的顺序；名称可以重复，名称索引记录每个名称对应的密钥。
+    # 写时复制：修改在锁内进行，每次修改生成新的快照后整体替换，读取只取当前快照的引用，
+    # 拿到的快照不会再变化，加解密线程可以随意遍历。事件在释放锁之后触发。
+    # 指纹只有加载过密钥内容后才知道，还没有指纹的密钥在按指纹查找时补充索引
     def __init__(self):
-        self._key_list: List[Key] = []
-        self._current_key:Key = None
+        self._write_lock = threading.RLock()
+        self._no_fingerprint: Dict[str, Key] = {}
+        self._snapshot = KeyCacheSnapshot(0, OrderedDict(), {}, {}, None)
 
         self.current_key_changed = Event()
         self.key_added = Event()
@@ -220,61 +435,277 @@ class KeyCache:
     def add_key_removed_callback(self, cb: Callable[[Key], None]):
         self.key_removed += cb
 
+    def snapshot(self) -> KeyCacheSnapshot:
+        return self._snapshot
+
+    def _publish(self, by_id=None, by_name=None, by_fingerprint=None, current_key=False):
+        # 调用方持有_write_lock，没有传入的部分沿用当前快照
+        old = self._snapshot
+        self._snapshot = KeyCacheSnapshot(
+            old.version + 1,
+            old._by_id if by_id is None else by_id,
+            old._by_name if by_name is None else by_name,
+            old._by_fingerprint if by_fingerprint is None else by_fingerprint,
+            old.current_key if current_key is False else current_key)
+
     def set_current_key(self, key: Key):
-        if key == self._current_key:
-            return
-        old_key = self._current_key
-        self._current_key = key
+        with self._write_lock:
+            old_key = self._snapshot.current_key
+            if key == old_key:
+                return
+            self._publish(current_key=key)
         self.current_key_changed(old_key, key)
 
-    def add_key(self, key: Key):
-        self._key_list.append(key)
-        self.key_added(key)
+    # 已经有相同id的密钥时不重复添加，返回缓存中的对象
+    def add_key(self, key: Key) -> Key:
+        return self.add_keys([key])[0]
+
+    # 一次加入多个密钥只生成一个快照
+    def add_keys(self, keys: List[Key]) -> List[Key]:
+        result = []
+        added = []
+        with self._write_lock:
+            snap = self._snapshot
+            by_id = OrderedDict(snap._by_id)
+            by_name = dict(snap._by_name)
+            by_fingerprint = dict(snap._by_fingerprint)
+            for key in keys:
+                cached_key = by_id.get(key.id)
+                if cached_key is not None:
+                    result.append(cached_key)
+                    continue
+                by_id[key.id] = key
+                by_name[key.name] = by_name.get(key.name, ()) + (key,)
+                if key.fingerprint is None:
+                    self._no_fingerprint[key.id] = key
+                else:
+                    by_fingerprint.setdefault(key.fingerprint, key)
+                result.append(key)
+                added.append(key)
+            if added:
+                self._publish(by_id, by_name, by_fingerprint)
+        for key in added:
+            self.key_added(key)
+        return result
+
+    def remove(self, key_id: str) -> Key:
+        with self._write_lock:
+            snap = self._snapshot
+            removed_key = snap.get(key_id)
+            if removed_key is None:
+                return None
+            by_id = OrderedDict(snap._by_id)
+            del by_id[key_id]
+            by_name = dict(snap._by_name)
+            same_name = tuple(key for key in by_name.get(removed_key.name, ()) if key is not removed_key)
+            if same_name:
+                by_name[removed_key.name] = same_name
+            else:
+                by_name.pop(removed_key.name, None)
+            self._no_fingerprint.pop(key_id, None)
+            by_fingerprint = snap._by_fingerprint
+            if by_fingerprint.get(removed_key.fingerprint) is removed_key:
+                by_fingerprint = dict(by_fingerprint)
+                del by_fingerprint[removed_key.fingerprint]
+                # 其他相同指纹的密钥补回索引
+                for key in by_id.values():
+                    if key.fingerprint == removed_key.fingerprint:
+                        by_fingerprint[key.fingerprint] = key
+                        break
+
+            current_changed = snap.current_key is not None and snap.current_key.id == key_id
+            self._publish(by_id, by_name, by_fingerprint, None if current_changed else False)
+
+        if current_changed:
+            self.current_key_changed(snap.current_key, None)
+        self.key_removed(removed_key)
+        return removed_key
 
     def remove_key(self, idx):
-        if self._current_key.id == self._key_list[idx]:
-            self._current_key = None
-        removed_key = self._key_list[idx]
-        del self._key_list[idx]
-        self.key_removed(removed_key)
+        return self.remove(self._snapshot.keys[idx].id)
+
+    def get(self, key_id: str, default: Key = None) -> Key:
+        return self._snapshot.get(key_id, default)
+
+    def contains(self, key_id: str) -> bool:
+        return key_id in self._snapshot
+
+    def __contains__(self, key_id: str):
+        return key_id in self._snapshot
+
+    def __len__(self):
+        return len(self._snapshot)
+
+    def __iter__(self):
+        return iter(self._snapshot)
+
+    def get_by_name(self, name: str) -> List[Key]:
+        return list(self._snapshot.get_by_name(name))
+
+    def find_by_fingerprint(self, fingerprint: str) -> Key:
+        key = self._snapshot.find_by_fingerprint(fingerprint)
+        if key is not None or not self._no_fingerprint:
+            return key
+        with self._write_lock:
+            loaded = [key for key in self._no_fingerprint.values() if key.fingerprint is not None]
+            if loaded:
+                by_fingerprint = dict(self._snapshot._by_fingerprint)
+                for key in loaded:
+                    del self._no_fingerprint[key.id]
+                    by_fingerprint.setdefault(key.fingerprint, key)
+                self._publish(by_fingerprint=by_fingerprint)
+        return self._snapshot.find_by_fingerprint(fingerprint)
 
     def get_cur_key(self):
-        return self._current_key
+        return self._snapshot.current_key
 
     def is_cur_key(self, key: Key):
-        if self._current_key is None:
+        current_key = self._snapshot.current_key
+        if current_key is None:
             return False
         if key is None:
             return False
-        return key.id == self._current_key.id
+        return key.id == current_key.id
 
+    # 当前快照中的密钥，返回的元组不会随缓存变化
     def get_key_list(self):
-        return self._key_list
+        return self._snapshot.keys
 
 
-def _check_key():
-    while True:
-        cache = KEY_CACHE
-        key_list = cache.get_key_list()
-        current_key = cache.get_cur_key()
+class KeyExpiryScheduler:
 
-        try:
-            KEY_CHECKER['current_keystatus'](current_key)
-        finally:
-            pass
+    # 密钥超时检查。到期时间放在小顶堆中，线程睡到最早的到期时间或者有变化时才醒来。
+    # 访问密钥只更新last_access，不改动堆；到期时按last_access重新计算，还没有到期的放回堆中。
+    # 同一个密钥在堆中可能有多条记录，只有_deadlines中记录的那一条有效
+    def __init__(self, cache: KeyCache, checker: dict):
+        self._cache = cache
+        self._checker = checker
+        self._heap = []
+        self._deadlines: Dict[str, float] = {}
+        # 到期时间相同时按加入的顺序，不比较Key对象
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._thread: threading.Thread = None
+        self._stopping = False
+
+        cache.add_key_added_callback(self.schedule)
+        cache.add_key_removed_callback(self._unschedule)
+        cache.add_current_key_changed_callback(self._current_key_changed)
 
-        for key in key_list:
-            last_tm = key.last_access
+    @property
+    def thread(self) -> threading.Thread:
+        return self._thread
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name='key-expiry', daemon=True)
+            self._thread.start()
+        for key in list(self._cache.get_key_list()):
+            self.schedule(key)
+        self._checker['current_keystatus'](self._cache.get_cur_key())
+
+    def stop(self, timeout: float = None):
+        with self._cond:
+            thread = self._thread
+            if thread is None:
+                return
+            self._stopping = True
+            self._cond.notify_all()
+        if thread is not threading.current_thread():
+            thread.join(timeout)
+        with self._cond:
+            self._thread = None
+            self._heap = []
+            self._deadlines = {}
+
+    def schedule(self, key: Key):
+        # 只管理缓存中的密钥，线程没有启动时不记录
+        if self._thread is None or key.timeout or self._cache.get(key.id) is not key:
+            return
+        deadline = key.last_access + self._timeout_of(key)
+        with self._cond:
+            if self._thread is None:
+                return
+            self._push(key, deadline)
+
+    def set_timeout(self, timeout: float):
+        with self._cond:
+            self._checker['timeout'] = timeout
+            self._reschedule_all()
+
+    def set_key_timeout(self, key: Key, timeout: float = None):
+        with self._cond:
+            key.expire_after = timeout
+            self._reschedule_all()
+
+    def _timeout_of(self, key: Key) -> float:
+        return key.expire_after if key.expire_after is not None else self._checker['timeout']
+
+    def _push(self, key: Key, deadline: float):
+        self._seq += 1
+        heapq.heappush(self._heap, (deadline, self._seq, key))
+        self._deadlines[key.id] = deadline
+        # 新的到期时间比线程等待的更早时叫醒线程
+        if self._heap[0][2] is key:
+            self._cond.notify_all()
+
+    def _reschedule_all(self):
+        # 超时时间变短时已经在堆中的到期时间都不对了，整体重建
+        if self._thread is None:
+            return
+        keys = {key.id: key for deadline, _, key in self._heap if self._deadlines.get(key.id) == deadline}
+        self._heap = []
+        self._deadlines = {}
+        for key in keys.values():
+            self._push(key, key.last_access + self._timeout_of(key))
+        self._cond.notify_all()
+
+    def _unschedule(self, key: Key):
+        # 堆中的记录在到期时丢弃
+        with self._cond:
+            self._deadlines.pop(key.id, None)
+
+    def _current_key_changed(self, old_key: Key, new_key: Key):
+        self._checker['current_keystatus'](new_key)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                expired = self._wait_expired()
+                if expired is None:
+                    return
+            for key in expired:
+                # 先标记超时再通知，回调中看到的是超时后的状态
+                key.timeout = True
+                self._checker['invalidate'](key)
+                if self._cache.is_cur_key(key):
+                    self._checker['current_keystatus'](key)
+
+    def _wait_expired(self):
+        while not self._stopping:
             now = time.time()
-            duration = now - last_tm
-            if key.timeout:
-                continue
-            if duration > KEY_CHECKER['timeout']:
-                try:
-                    KEY_CHECKER['invalidate'](key)
-                finally:
-                    key.timeout = True
-        time.sleep(1)
+            expired = []
+            while self._heap and self._heap[0][0] <= now:
+                deadline, _, key = heapq.heappop(self._heap)
+                if self._deadlines.get(key.id) != deadline:
+                    continue
+                del self._deadlines[key.id]
+                if key.timeout or self._cache.get(key.id) is not key:
+                    continue
+                # 正在使用的密钥相当于刚刚访问过
+                last_access = now if key.in_use else key.last_access
+                actual_deadline = last_access + self._timeout_of(key)
+                if actual_deadline > now:
+                    self._push(key, actual_deadline)
+                else:
+                    expired.append(key)
+            if expired:
+                return expired
+            self._cond.wait(self._heap[0][0] - now if self._heap else None)
+        return None
 
 
 KEY_CACHE = KeyCache()
@@ -284,16 +715,32 @@ KEY_CHECKER = {
     'thread': None,
     'timeout': 60 * 5
 }
+KEY_SCHEDULER = KeyExpiryScheduler(KEY_CACHE, KEY_CHECKER)
+
+
+def _key_activated(key: Key):
+    # 超时后重新加载的密钥重新开始计时，当前密钥的状态变了要通知，否则一直显示超时
+    KEY_SCHEDULER.schedule(key)
+    if KEY_CACHE.is_cur_key(key):
+        KEY_CHECKER['current_keystatus'](key)
 
 
 def set_key_timeout(timeout: int):
-    KEY_CHECKER['timeout'] = timeout
+    KEY_SCHEDULER.set_timeout(timeout)
+
+
+def set_key_expire_after(key: Key, timeout: float = None):
+    KEY_SCHEDULER.set_key_timeout(key, timeout)
 
 
 def start_check_key_thread():
-    if KEY_CHECKER['thread'] is None:
-        _CHECK_KEY_THREAD = threading.Thread(target=_check_key, daemon=True)
-        _CHECK_KEY_THREAD.start()
+    KEY_SCHEDULER.start()
+    KEY_CHECKER['thread'] = KEY_SCHEDULER.thread
+
+
+def stop_check_key_thread(timeout: float = None):
+    KEY_SCHEDULER.stop(timeout)
+    KEY_CHECKER['thread'] = None
 
 
 def add_key_invalidate_callback(cb: Callable[[Key], None]):
@@ -302,4 +749,3 @@ def add_key_invalidate_callback(cb: Callable[[Key], None]):
 
 def add_current_keystatus_callback(cb: Callable[[Key], None]):
     KEY_CHECKER['current_keystatus'] += cb
-
@@ -0,0 +1,158 @@
+import hashlib
+import json
+import os
+
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad
+
+from keymanager import _HEAD_LENGTH
+from keymanager.atomic import _fsync_dir
+from keymanager.encryptor import generate_iv, make_header, parse_header, get_format_version, \
+    InvalidEncryptDataException, FORMAT_V1, _STREAM_CHUNK_SIZE, _check_chunk_size, _read_full
+
+# 可断点续传的加密，输出为v1格式。
+# 每加密checkpoint_interval字节，先把输出fsync到磁盘，再在输出文件旁写入检查点：
+# 已加密的明文长度、CBC链状态（最后一个密文块）、检查点前一块明文的摘要。
+# 重新执行时检查点有效就截断输出到检查点位置，从那里继续加密。
+# 加密过程中输出写在目标文件旁的.part文件中，全部完成并落盘后才改名为目标文件，
+# 崩溃时目标路径上不会出现头部完整、密文不完整的文件
+
+_CHECKPOINT_SUFFIX = '.ckpt'
+_PART_SUFFIX = '.part'
+_CHECKPOINT_INTERVAL = 64 * 1024 * 1024
+
+
+def get_checkpoint_path(dst_path: str) -> str:
+    return dst_path + _CHECKPOINT_SUFFIX
+
+
+def get_part_path(dst_path: str) -> str:
+    return dst_path + _PART_SUFFIX
+
+
+def encrypt_file_resumable(key, src_path: str, dst_path: str,
+                           chunk_size: int = _STREAM_CHUNK_SIZE,
+                           checkpoint_interval: int = _CHECKPOINT_INTERVAL) -> int:
+    _check_chunk_size(chunk_size)
+    checkpoint_path = get_checkpoint_path(dst_path)
+    part_path = get_part_path(dst_path)
+    src_stat = os.stat(src_path)
+    length = src_stat.st_size
+
+    with open(src_path, 'rb') as src:
+        checkpoint = _load_checkpoint(checkpoint_path, key, src_stat, chunk_size)
+        resumed = checkpoint is not None and _prepare_resume(checkpoint, src, part_path)
+
+        if resumed:
+            dst = open(part_path, 'r+b')
+            dst.seek(_HEAD_LENGTH + checkpoint['offset'])
+            src.seek(checkpoint['offset'])
+            offset = checkpoint['offset']
+            iv = bytes.fromhex(checkpoint['iv'])
+            cipher = AES.new(key, AES.MODE_CBC, bytes.fromhex(checkpoint['chain']))
+        else:
+            dst = open(part_path, 'wb')
+            offset = 0
+            iv = generate_iv()
+            cipher = AES.new(key, AES.MODE_CBC, iv)
+            dst.write(make_header(length, iv))
+
+        with dst:
+            last_checkpoint = offset
+            chunk = _read_full(src, chunk_size)
+            while True:
+                next_chunk = _read_full(src, chunk_size)
+                if not next_chunk:
+                    dst.write(cipher.encrypt(pad(chunk, AES.block_size, style='pkcs7')))
+                    offset += len(chunk)
+                    break
+
+                enc_chunk = cipher.encrypt(chunk)
+                dst.write(enc_chunk)
+                offset += len(chunk)
+
+                if offset - last_checkpoint >= checkpoint_interval:
+                    _save_checkpoint(checkpoint_path, dst, {
+                        'src_size': length,
+                        'src_mtime_ns': src_stat.st_mtime_ns,
+                        'key_check': _key_check(key, iv),
+                        'chunk_size': chunk_size,
+                        'offset': offset,
+                        'iv': iv.hex(),
+                        'chain': enc_chunk[-AES.block_size:].hex(),
+                        'digest': hashlib.sha256(chunk).hexdigest(),
+                    })
+                    last_checkpoint = offset
+                chunk = next_chunk
+
+            if offset != length:
+                raise InvalidEncryptDataException('加密过程中源文件被修改')
+            dst.flush()
+            os.fsync(dst.fileno())
+
+    os.replace(part_path, dst_path)
+    _fsync_dir(os.path.dirname(os.path.abspath(dst_path)))
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return length
+
+
+def _key_check(key, iv: bytes) -> str:
+    # 只用来确认续传时使用的是同一个密钥，不能泄露密钥本身
+    return hashlib.sha256(b'keymanager-checkpoint' + iv + bytes(key)).hexdigest()
+
+
+def _load_checkpoint(checkpoint_path: str, key, src_stat, chunk_size: int):
+    if not os.path.exists(checkpoint_path):
+        return None
+    try:
+        with open(checkpoint_path, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+        iv = bytes.fromhex(checkpoint['iv'])
+        if checkpoint['src_size'] != src_stat.st_size or checkpoint['src_mtime_ns'] != src_stat.st_mtime_ns:
+            return None
+        if checkpoint['key_check'] != _key_check(key, iv) or checkpoint['chunk_size'] != chunk_size:
+            return None
+        return checkpoint
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def _prepare_resume(checkpoint, src, part_path: str) -> bool:
+    offset = checkpoint['offset']
+    chunk_size = checkpoint['chunk_size']
+    if offset <= 0 or offset % chunk_size != 0 or not os.path.exists(part_path):
+        return False
+
+    with open(part_path, 'r+b') as dst:
+        header = _read_full(dst, _HEAD_LENGTH)
+        if len(header) < _HEAD_LENGTH or get_format_version(header) != FORMAT_V1:
+            return False
+        data_len, iv = parse_header(header)
+        if data_len != checkpoint['src_size'] or iv.hex() != checkpoint['iv']:
+            return False
+
+        # 检查点之前的输出必须完整，最后一个密文块要和记录的链状态一致
+        dst.seek(_HEAD_LENGTH + offset - AES.block_size)
+        if dst.read(AES.block_size).hex() != checkpoint['chain']:
+            return False
+
+        # 重新读取检查点前一块明文，确认源文件没有被改动过
+        src.seek(offset - chunk_size)
+        if hashlib.sha256(_read_full(src, chunk_size)).hexdigest() != checkpoint['digest']:
+            return False
+
+        dst.truncate(_HEAD_LENGTH + offset)
+    return True
+
+
+def _save_checkpoint(checkpoint_path: str, dst, checkpoint):
+    # 先保证输出落盘，检查点才不会指向还没写入的数据
+    dst.flush()
+    os.fsync(dst.fileno())
+    tmp_path = checkpoint_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, checkpoint_path)
@@ -0,0 +1,107 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, NamedTuple
+
+from keymanager import _HEAD_MARKER_BYTE_SIZE, _HEAD_FILE_SIZE_BYTE_SIZE, _CHUNKED_HEAD_LENGTH
+from keymanager.encryptor import get_format_version, parse_chunked_header, InvalidEncryptDataException, FORMAT_V1
+from keymanager.utils import read_header
+
+# 所有格式的头部都以marker和明文长度开始，判断文件类型只需要读这一部分；
+# 分块格式再多读flags，流式格式的明文长度是未知的
+_SCAN_HEADER_LENGTH = _HEAD_MARKER_BYTE_SIZE + _HEAD_FILE_SIZE_BYTE_SIZE
+
+
+class HeaderInfo(NamedTuple):
+    path: str
+    size: int = None
+    # 未加密的文件version和data_len为None，流式格式的data_len为None
+    version: int = None
+    data_len: int = None
+    error: Exception = None
+
+    @property
+    def encrypted(self) -> bool:
+        return self.version is not None
+
+
+def scan_file(path: str, size: int = None) -> HeaderInfo:
+    try:
+        header = read_header(path, _CHUNKED_HEAD_LENGTH)
+        if size is None:
+            size = os.path.getsize(path)
+    except OSError as e:
+        return HeaderInfo(path, size, error=e)
+
+    version = get_format_version(header)
+    if version is None or len(header) < _SCAN_HEADER_LENGTH:
+        return HeaderInfo(path, size)
+    data_len = int.from_bytes(header[_HEAD_MARKER_BYTE_SIZE:_SCAN_HEADER_LENGTH], byteorder='big')
+    if version != FORMAT_V1:
+        try:
+            if parse_chunked_header(header).framed:
+                data_len = None
+        except InvalidEncryptDataException as e:
+            return HeaderInfo(path, size, version, data_len, e)
+    return HeaderInfo(path, size, version, data_len)
+
+
+def scan_files(paths: Iterable[str], workers: int = None) -> Iterator[HeaderInfo]:
+    return _bounded_map(lambda path: scan_file(path), paths, workers)
+
+
+# 递归扫描目录，文件大小取自scandir，结果顺序与遍历顺序一致
+def scan_tree(root: str, workers: int = None, follow_symlinks: bool = False) -> Iterator[HeaderInfo]:
+    items = ((path, stat.st_size) for path, stat in walk_files(root, follow_symlinks))
+    return _bounded_map(lambda item: scan_file(*item), items, workers)
+
+
+def filter_encrypted(infos: Iterable[HeaderInfo], encrypted: bool = True) -> Iterator[str]:
+    for info in infos:
+        if info.error is None and info.encrypted == encrypted:
+            yield info.path
+
+
+# 按名称顺序遍历目录下的所有文件，返回(path, stat)，stat来自scandir，windows下不需要额外的系统调用。
+# root无法读取时直接抛出异常，不会当作空目录；子目录和条目读取失败时交给on_error(path, error)，
+# 没有指定on_error时跳过
+def walk_files(root: str, follow_symlinks: bool = False, skip_dir: Callable[[str], bool] = None,
+               on_error: Callable[[str, OSError], None] = None):
+    dirs = [root]
+    while dirs:
+        current = dirs.pop()
+        try:
+            entries = list(os.scandir(current))
+        except OSError as e:
+            if current == root:
+                raise
+            if on_error is not None:
+                on_error(current, e)
+            continue
+        entries.sort(key=lambda e: e.name)
+        sub_dirs = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=follow_symlinks):
+                    if skip_dir is None or not skip_dir(entry.path):
+                        sub_dirs.append(entry.path)
+                elif entry.is_file(follow_symlinks=follow_symlinks):
+                    yield entry.path, entry.stat(follow_symlinks=follow_symlinks)
+            except OSError as e:
+                if on_error is not None:
+                    on_error(entry.path, e)
+                continue
+        dirs.extend(reversed(sub_dirs))
+
+
+def _bounded_map(fn: Callable, items: Iterable, workers: int = None) -> Iterator:
+    # 同时在途的任务数有上限，十万级文件也不会一次性创建全部future
+    workers = workers or min(32, (os.cpu_count() or 1) * 4)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= workers * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Tuple
+
+from keymanager.atomic import atomic_open, atomic_write, SyncGroup
+from keymanager.encryptor import encrypt_stream, encrypted_file_size, FORMAT_V1, _STREAM_CHUNK_SIZE
+from keymanager.key import Key
+from keymanager.scanner import walk_files
+
+# 增量同步：把src_dir下的文件按原来的目录结构加密到output_dir。
+# 清单记录每个源文件的大小、修改时间、内容摘要、密钥id和输出路径，
+# 再次同步时先比较stat，没有变化的文件不会被读取；stat变化但内容摘要相同的只更新清单
+
+MANIFEST_NAME = '.keymanager-manifest.json'
+_MANIFEST_VERSION = 1
+
+
+class SyncResult:
+
+    def __init__(self):
+        self.added: List[str] = []
+        self.updated: List[str] = []
+        self.unchanged: List[str] = []
+        self.removed: List[str] = []
+        self.failed: List[Tuple[str, Exception]] = []
+        # 源目录中读取失败的子目录或文件，相对路径
+        self.scan_errors: List[Tuple[str, Exception]] = []
+
+
+def sync_dir(key: Key,
+             src_dir: str,
+             output_dir: str,
+             version: int = FORMAT_V1,
+             workers: int = None,
+             manifest_path: str = None,
+             delete_removed: bool = True,
+             verify_hash: bool = True) -> SyncResult:
+    src_dir = os.path.abspath(src_dir)
+    output_dir = os.path.abspath(output_dir)
+    if manifest_path is None:
+        manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    os.makedirs(output_dir, exist_ok=True)
+
+    # 同步期间占用密钥，不会因为超时被清除
+    with key.use() as raw_key:
+        manifest = load_manifest(manifest_path)
+        entries: Dict[str, dict] = manifest['entries']
+        result = SyncResult()
+
+        # 输出目录在源目录里面时不能再把输出当作源文件
+        def skip_dir(path):
+            return os.path.normcase(os.path.abspath(path)) == os.path.normcase(output_dir)
+
+        def on_error(path, error):
+            result.scan_errors.append((os.path.relpath(path, src_dir).replace(os.sep, '/'), error))
+
+        seen = set()
+        tasks = []
+        # 源目录不存在或无法读取时抛出异常，不会把清单中的文件都当作已删除
+        for src_path, stat in walk_files(src_dir, skip_dir=skip_dir, on_error=on_error):
+            rel_path = os.path.relpath(src_path, src_dir).replace(os.sep, '/')
+            seen.add(rel_path)
+            entry = entries.get(rel_path)
+            output_path = os.path.join(output_dir, *rel_path.split('/'))
+            if _is_unchanged(entry, stat, key.id, version, output_path):
+                result.unchanged.append(rel_path)
+                continue
+            tasks.append((rel_path, src_path, output_path, stat, entry))
+
+        sync_group = SyncGroup()
+        # 输出在组提交时才改名到目标路径，提交成功后才写入清单，提交失败时下次同步会重新加密
+        staged: Dict[str, dict] = {}
+        try:
+            with sync_group, ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = {
+                    executor.submit(_sync_file, raw_key, key.id, src_path, output_path, stat, entry, version,
+                                    verify_hash, sync_group):
+                        (rel_path, entry)
+                    for rel_path, src_path, output_path, stat, entry in tasks
+                }
+                for future in as_completed(futures):
+                    rel_path, entry = futures[future]
+                    try:
+                        new_entry, encrypted = future.result()
+                    except Exception as e:
+                        result.failed.append((rel_path, e))
+                        continue
+                    staged[rel_path] = new_entry
+                    if not encrypted:
+                        result.unchanged.append(rel_path)
+                    elif entry is None:
+                        result.added.append(rel_path)
+                    else:
+                        result.updated.append(rel_path)
+            entries.update(staged)
+
+            # 遍历不完整时无法区分删除和读取失败，这次不删除任何输出，读取失败的目录下的条目保留在清单中
+            if delete_removed and not result.scan_errors:
+                for rel_path in [p for p in entries if p not in seen]:
+                    output_path = entries[rel_path]['output']
+                    if os.path.exists(output_path):
+                        os.remove(output_path)
+                    del entries[rel_path]
+                    result.removed.append(rel_path)
+        finally:
+            save_manifest(manifest_path, manifest)
+
+        return result
+
+
+def load_manifest(manifest_path: str) -> dict:
+    if not os.path.exists(manifest_path):
+        return {'version': _MANIFEST_VERSION, 'entries': {}}
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        manifest = json.load(f)
+    if manifest.get('version') != _MANIFEST_VERSION:
+        raise ValueError('不支持的清单版本：{}'.format(manifest.get('version')))
+    return manifest
+
+
+def save_manifest(manifest_path: str, manifest: dict):
+    atomic_write(manifest_path, json.dumps(manifest, ensure_ascii=False, indent=1).encode('utf-8'))
+
+
+def _is_unchanged(entry, stat, key_id: str, version: int, output_path: str) -> bool:
+    if entry is None:
+        return False
+    return entry['size'] == stat.st_size \
+        and entry['mtime_ns'] == stat.st_mtime_ns \
+        and entry['key_id'] == key_id \
+        and entry['version'] == version \
+        and entry['output'] == output_path \
+        and os.path.exists(output_path)
+
+
+def _sync_file(raw_key, key_id: str, src_path: str, output_path: str, stat, entry, version: int,
+               verify_hash: bool, sync_group: SyncGroup):
+    new_entry = {
+        'src_path': src_path,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'hash': None,
+        'key_id': key_id,
+        'output': output_path,
+        'version': version,
+    }
+
+    # 只有修改时间变了，内容没变时不需要重新加密
+    if verify_hash and entry is not None and entry['size'] == stat.st_size and entry['key_id'] == key_id \
+            and entry['version'] == version and entry['output'] == output_path and os.path.exists(output_path):
+        content_hash = _file_hash(src_path)
+        if content_hash == entry['hash']:
+            new_entry['hash'] = content_hash
+            return new_entry, False
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    hasher = hashlib.sha256()
+    output_size = encrypted_file_size(stat.st_size, version)
+    with open(src_path, 'rb') as src, atomic_open(output_path, output_size, sync_group) as dst:
+        encrypt_stream(raw_key, _HashingReader(src, hasher), dst, length=stat.st_size, version=version)
+    new_entry['hash'] = hasher.hexdigest()
+    return new_entry, True
+
+
+def _file_hash(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_STREAM_CHUNK_SIZE), b''):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+class _HashingReader:
+
+    # 加密时顺便计算内容摘要，不需要再读一遍源文件
+    def __init__(self, src, hasher):
+        self._src = src
+        self._hasher = hasher
+
+    def read(self, size=-1):
+        data = self._src.read(size)
+        self._hasher.update(data)
+        return data
+
+    def seekable(self):
+        return False
@@ -0,0 +1,323 @@
+import os
+import queue
+import threading
+from typing import Iterator, List
+
+from axel import Event
+from Crypto.Cipher import AES
+from Crypto.Util.Padding import pad
+
+from keymanager import _HEAD_MARKER_BYTE_SIZE, _CHUNKED_HEAD_LENGTH
+from keymanager.atomic import AtomicFile, SyncGroup
+from keymanager.batch import FileResult, STATUS_DONE, STATUS_SKIPPED, STATUS_FAILED, STATUS_CANCELED
+from keymanager.encryptor import generate_iv, make_header, is_encrypt_data, encrypted_size, \
+    InvalidEncryptDataException, FORMAT_V1, COMPRESS_NONE, _STREAM_CHUNK_SIZE, _check_chunk_size, _read_full, _new_chunked_header, \
+    _encrypt_chunk, _index_bytes, _fixed_offsets
+from keymanager.scanner import walk_files
+
+# 目录加密，按原来的目录结构输出。分三个阶段，用有界队列连接：
+#   读取线程：依次打开源文件，按块读取明文
+#   加密线程：加密收到的块
+#   写入线程：打开输出文件，写入头部和密文，文件结束后关闭，整批结束后统一fsync和改名
+# 读盘、加密和写盘同时进行，队列有上限，内存占用只和块大小、线程数有关。
+# v1格式和启用压缩时同一个文件的块必须按顺序处理，整个文件交给同一个加密线程；
+# 未压缩的分块格式每块的位置是固定的，块可以分给不同的加密线程，写入时按位置写
+
+_QUEUE_SIZE_PER_WORKER = 2
+
+
+class _TreeTask:
+
+    def __init__(self, result: FileResult, file_no: int):
+        self.result = result
+        self.file_no = file_no
+        self.length = 0
+        self.header_bytes = b''
+        # 只有v1格式使用，CBC的状态在同一个加密线程中延续
+        self.cipher = None
+        self.header = None
+        self.output_size = None
+        self.offsets: List[int] = None
+        self.fixed_size = False
+        self.dst = None
+        # 读取线程已经发出的块数，结束标记到达后才确定
+        self.queued = 0
+        self.written = 0
+        self.sent = None
+        self.error: Exception = None
+        self.canceled = False
+
+
+class TreeEncryptor:
+
+    # root下的文件输出到output_dir下相同的相对路径，接口与BatchProcessor相同，可以直接用在run_batch_with_progress中
+    def __init__(self,
+                 key,
+                 root: str,
+                 version: int = FORMAT_V1,
+                 chunk_size: int = _STREAM_CHUNK_SIZE,
+                 compression: int = COMPRESS_NONE,
+                 workers: int = None):
+        _check_chunk_size(chunk_size)
+        self.key = key
+        self.root = os.path.abspath(root)
+        self.version = version
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.workers = workers or os.cpu_count() or 1
+
+        self._canceled = threading.Event()
+        # 调用方提前结束时内部使用的停止标记，每次process重新创建，不影响was_canceled
+        self._stopped = threading.Event()
+        self._sync_group: SyncGroup = None
+
+        # 回调在写入线程中执行
+        self.file_done = Event(threads=0)
+        self.file_failed = Event(threads=0)
+
+    def add_file_done_callback(self, cb):
+        self.file_done += cb
+
+    def add_file_failed_callback(self, cb):
+        self.file_failed += cb
+
+    def cancel(self):
+        self._canceled.set()
+
+    def was_canceled(self):
+        return self._canceled.is_set()
+
+    def _should_stop(self) -> bool:
+        return self._canceled.is_set() or self._stopped.is_set()
+
+    def process(self, file_list: List[str], output_dir: str) -> Iterator[FileResult]:
+        output_dir = os.path.abspath(output_dir)
+        if os.path.normcase(output_dir) == os.path.normcase(self.root):
+            raise ValueError('输出目录不能与源目录相同')
+
+        cipher_queues = [queue.Queue(_QUEUE_SIZE_PER_WORKER) for _ in range(self.workers)]
+        write_queue = queue.Queue(self.workers * _QUEUE_SIZE_PER_WORKER)
+        results = queue.Queue()
+        self._stopped = threading.Event()
+        self._sync_group = SyncGroup()
+
+        threads = [threading.Thread(target=self._read_files, args=(file_list, output_dir, cipher_queues, write_queue),
+                                    daemon=True)]
+        threads.extend(threading.Thread(target=self._encrypt_chunks, args=(cipher_queue, write_queue), daemon=True)
+                       for cipher_queue in cipher_queues)
+        threads.append(threading.Thread(target=self._write_files, args=(write_queue, results), daemon=True))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                result = results.get()
+                if result is None:
+                    break
+                yield result
+        finally:
+            # 调用方提前结束时通知读取线程停止，写入线程会继续消费队列，各线程都能退出
+            self._stopped.set()
+            for thread in threads:
+                thread.join()
+            self._sync_group.commit()
+
+    def run(self, file_list: List[str], output_dir: str) -> List[FileResult]:
+        return list(self.process(file_list, output_dir))
+
+    def _output_path(self, src_path: str, output_dir: str) -> str:
+        rel_path = os.path.relpath(os.path.abspath(src_path), self.root)
+        if rel_path == os.pardir or rel_path.startswith(os.pardir + os.sep) or os.path.isabs(rel_path):
+            raise ValueError('文件不在源目录中：{}'.format(src_path))
+        return os.path.join(output_dir, rel_path)
+
+    def _read_files(self, file_list, output_dir, cipher_queues, write_queue):
+        try:
+            for file_no, src_path in enumerate(file_list):
+                task = _TreeTask(FileResult(src_path, None), file_no)
+                try:
+                    task.result.dst_path = self._output_path(src_path, output_dir)
+                    if self._should_stop():
+                        task.canceled = True
+                    elif not os.path.exists(src_path):
+                        task.result.status = STATUS_SKIPPED
+                    else:
+                        self._read_file(task, cipher_queues)
+                except Exception as e:
+                    task.error = task.error or e
+                write_queue.put(('end', task, task.queued))
+        finally:
+            for cipher_queue in cipher_queues:
+                cipher_queue.put(None)
+
+    def _read_file(self, task: _TreeTask, cipher_queues):
+        with open(task.result.src_path, 'rb') as src:
+            if is_encrypt_data(src.read(_HEAD_MARKER_BYTE_SIZE)):
+                task.result.status = STATUS_SKIPPED
+                return
+            src.seek(0)
+            task.length = os.fstat(src.fileno()).st_size
+
+            if self.version == FORMAT_V1 and self.compression == COMPRESS_NONE:
+                iv = generate_iv()
+                task.cipher = AES.new(self.key, AES.MODE_CBC, iv)
+                task.header_bytes = make_header(task.length, iv)
+                task.output_size = encrypted_size(task.length)
+                # 空文件也有一个填充块
+                chunk_count = max(1, -(-task.length // self.chunk_size))
+            else:
+                task.header = _new_chunked_header(self.version, task.length, self.chunk_size, self.compression)
+                task.header_bytes = task.header.to_bytes()
+                task.fixed_size = self.compression == COMPRESS_NONE
+                if task.fixed_size:
+                    task.offsets = _fixed_offsets(task.header)
+                    task.output_size = task.offsets[-1]
+                else:
+                    task.offsets = [task.header.data_offset]
+                chunk_count = task.header.chunk_count
+
+            for idx in range(chunk_count):
+                if self._should_stop():
+                    task.canceled = True
+                    return
+                data_len = min(self.chunk_size, task.length - idx * self.chunk_size)
+                raw_chunk = _read_full(src, data_len)
+                if len(raw_chunk) != data_len:
+                    raise InvalidEncryptDataException('加密过程中源文件被修改')
+                worker = task.file_no + idx if task.fixed_size else task.file_no
+                cipher_queues[worker % len(cipher_queues)].put((task, idx, raw_chunk, idx == chunk_count - 1))
+                task.queued += 1
+
+            if src.read(1):
+                raise InvalidEncryptDataException('加密过程中源文件被修改')
+
+    def _encrypt_chunks(self, cipher_queue, write_queue):
+        while True:
+            item = cipher_queue.get()
+            if item is None:
+                break
+            task, idx, raw_chunk, last = item
+            enc_chunk = None
+            if task.error is None and not task.canceled:
+                try:
+                    if task.cipher is None:
+                        enc_chunk = _encrypt_chunk(self.key, task.header, idx, raw_chunk)
+                    elif last:
+                        enc_chunk = task.cipher.encrypt(pad(raw_chunk, AES.block_size, style='pkcs7'))
+                    else:
+                        enc_chunk = task.cipher.encrypt(raw_chunk)
+                except Exception as e:
+                    task.error = task.error or e
+            write_queue.put(('chunk', task, idx, enc_chunk))
+        write_queue.put(None)
+
+    def _write_files(self, write_queue, results):
+        # 读取线程先发出所有文件的结束标记，再通知加密线程退出，收到所有加密线程的退出标记时不会再有数据
+        running_workers = self.workers
+        try:
+            while running_workers > 0:
+                item = write_queue.get()
+                if item is None:
+                    running_workers -= 1
+                    continue
+                if item[0] == 'end':
+                    _, task, task.sent = item
+                else:
+                    _, task, idx, enc_chunk = item
+                    task.written += 1
+                    if enc_chunk is not None and task.error is None and not task.canceled:
+                        try:
+                            self._write_chunk(task, idx, enc_chunk)
+                        except Exception as e:
+                            task.error = task.error or e
+                # 块可能在结束标记之后才到达，全部写完才算结束
+                if task.sent is not None and task.written == task.sent:
+                    results.put(self._finish_task(task))
+        finally:
+            results.put(None)
+
+    def _open_output(self, task: _TreeTask):
+        os.makedirs(os.path.dirname(task.result.dst_path), exist_ok=True)
+        task.dst = AtomicFile(task.result.dst_path, task.output_size, self._sync_group)
+        task.dst.file.write(task.header_bytes)
+        if task.offsets is not None:
+            # 块长度不固定时先占位，写完所有块后回填索引
+            task.dst.file.write(_index_bytes(task.offsets) if task.fixed_size
+                                else bytes(task.header.data_offset - _CHUNKED_HEAD_LENGTH))
+
+    def _write_chunk(self, task: _TreeTask, idx: int, enc_chunk: bytes):
+        if task.dst is None:
+            self._open_output(task)
+        if task.fixed_size:
+            task.dst.file.seek(task.offsets[idx])
+        elif task.offsets is not None:
+            task.offsets.append(task.offsets[-1] + len(enc_chunk))
+        task.dst.file.write(enc_chunk)
+
+    def _finish_task(self, task: _TreeTask) -> FileResult:
+        result = task.result
+        ok = task.error is None and not task.canceled
+        try:
+            # 分块格式的空文件没有块，只有头部和索引
+            if task.dst is None and ok and result.status is None:
+                self._open_output(task)
+            if task.dst is not None and ok:
+                f = task.dst.file
+                if task.fixed_size:
+                    # 块是乱序写入的，把位置移到末尾，提交时按位置确定文件长度
+                    f.seek(task.offsets[-1])
+                elif task.offsets is not None:
+                    f.seek(_CHUNKED_HEAD_LENGTH)
+                    f.write(_index_bytes(task.offsets))
+                    f.seek(task.offsets[-1])
+                task.dst.commit()
+                task.dst = None
+        except Exception as e:
+            task.error = task.error or e
+
+        if task.dst is not None:
+            task.dst.discard()
+            task.dst = None
+
+        if task.error is not None:
+            result.status = STATUS_FAILED
+            result.error = task.error
+        elif task.canceled:
+            result.status = STATUS_CANCELED
+        elif result.status is None:
+            result.status = STATUS_DONE
+            result.length = task.length
+
+        if result.status == STATUS_FAILED:
+            self.file_failed(result)
+        else:
+            self.file_done(result)
+        return result
+
+
+def list_tree(root: str, output_dir: str = None, follow_symlinks: bool = False) -> List[str]:
+    # 输出目录在源目录里面时跳过，不会把输出当作源文件
+    skip_dir = None
+    if output_dir is not None:
+        output_key = os.path.normcase(os.path.abspath(output_dir))
+
+        def skip_dir(path):
+            return os.path.normcase(os.path.abspath(path)) == output_key
+    return [path for path, _ in walk_files(root, follow_symlinks, skip_dir)]
+
+
+def encrypt_tree(key,
+                 src_dir: str,
+                 output_dir: str,
+                 version: int = FORMAT_V1,
+                 chunk_size: int = _STREAM_CHUNK_SIZE,
+                 compression: int = COMPRESS_NONE,
+                 workers: int = None,
+                 on_result=None,
+                 on_error=None) -> List[FileResult]:
+    encryptor = TreeEncryptor(key, src_dir, version, chunk_size, compression, workers)
+    if on_result is not None:
+        encryptor.add_file_done_callback(on_result)
+    if on_error is not None:
+        encryptor.add_file_failed_callback(on_error)
+    return encryptor.run(list_tree(src_dir, output_dir), output_dir)
@@ -1,9 +1,8 @@
 import copy
 import importlib
 
-from PySide6.QtGui import QIcon
-
 from keymanager import _HEAD_MARKER_BYTE_SIZE
+from keymanager.atomic import atomic_write
 import appdirs
 import os
 
@@ -14,9 +13,9 @@ ICON_COLOR = {
 }
 
 
-def write_file(path: str, bs: bytes):
-    with open(path, 'wb') as f:
-        f.write(bs)
+# 先写临时文件再改名，写到一半崩溃也不会留下不完整的文件
+def write_file(path: str, bs: bytes, sync_group=None, mode: int = None):
+    atomic_write(path, bs, sync_group, mode=mode)
 
 
 def read_file(path: str):
@@ -24,9 +23,9 @@ def read_file(path: str):
         return f.read()
 
 
-def read_header(path: str):
+def read_header(path: str, length: int = _HEAD_MARKER_BYTE_SIZE):
     with open(path, 'rb') as f:
-        return f.read(_HEAD_MARKER_BYTE_SIZE)
+        return f.read(length)
 
 
 def get_user_data_dir():
@@ -77,6 +76,7 @@ get_icon_name_func_name = ''
 def getIconConfig(name: str):
 
     from typing import List, Any
+    from PySide6.QtGui import QIcon
 
     try:
         external = importlib.import_module(external_module_name)
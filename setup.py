@@ -55,6 +55,13 @@ setup(
     python_requires='>=3.8',
     install_requires=read_requirements('requirements.txt'),
     packages=['keymanager', 'keymanager.ui'],
+    entry_points={
+        'console_scripts': [
+            'keymanager=keymanager.cli:main',
+            'keymanager-encrypt=keymanager.cli:encrypt_filter_main',
+            'keymanager-decrypt=keymanager.cli:decrypt_filter_main',
+        ],
+    },
     long_description=read_README('README.md'),
     classifiers=[
         'Development Status :: 3 - Alpha',
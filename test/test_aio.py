@@ -0,0 +1,42 @@
+import asyncio
+import os
+import tempfile
+import unittest
+
+from keymanager import aio
+from keymanager.key import Key, KEY_CACHE, KeyTimeOutException
+
+
+class LoadKeyTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.key_path = os.path.join(self._tmp.name, 'test.key')
+        self.raw_key = os.urandom(32)
+        key = Key()
+        key.name = 'test'
+        key.key = self.raw_key
+        key.save(self.key_path, 'password', calc_md5=False)
+        self.key_id = key.id
+
+    def tearDown(self):
+        KEY_CACHE.remove(self.key_id)
+        self._tmp.cleanup()
+
+    def test_reload_after_timeout(self):
+        async def main():
+            key = await aio.load_key(self.key_path, 'password')
+            key.timeout = True
+            with self.assertRaises(KeyTimeOutException):
+                key.key
+            reloaded = await aio.load_key(self.key_path, 'password')
+            return key, reloaded
+
+        key, reloaded = asyncio.run(main())
+        self.assertIs(reloaded, key)
+        self.assertFalse(key.timeout)
+        self.assertEqual(key.key, self.raw_key)
+
+
+if __name__ == '__main__':
+    unittest.main()
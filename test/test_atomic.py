@@ -0,0 +1,69 @@
+import os
+import stat
+import tempfile
+import unittest
+import zipfile
+from io import BytesIO
+
+from keymanager.atomic import atomic_write
+from keymanager.key import Key, migrate_key_file, get_key_file_version, KEY_FORMAT_V2
+
+
+def _mode(path):
+    return stat.S_IMODE(os.stat(path).st_mode)
+
+
+@unittest.skipIf(os.name == 'nt', 'windows没有posix权限')
+class FileModeTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.dir = self._tmp.name
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_overwrite_keeps_mode(self):
+        path = os.path.join(self.dir, 'data')
+        atomic_write(path, b'old')
+        os.chmod(path, 0o640)
+        atomic_write(path, b'new')
+        self.assertEqual(_mode(path), 0o640)
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'new')
+
+    def test_new_file_mode(self):
+        path = os.path.join(self.dir, 'data')
+        atomic_write(path, b'data', mode=0o600)
+        self.assertEqual(_mode(path), 0o600)
+
+    def test_key_file_mode(self):
+        key = Key()
+        key.name = 'test'
+        key.key = os.urandom(32)
+        key_path = os.path.join(self.dir, 'test.key')
+        key.save(key_path, calc_md5=False)
+        self.assertEqual(_mode(key_path), 0o600)
+
+        os.chmod(key_path, 0o640)
+        key.save(key_path, 'password', calc_md5=False)
+        self.assertEqual(_mode(key_path), 0o640)
+
+    def test_migrate_keeps_mode(self):
+        # 旧格式的密钥文件是zip
+        buffer = BytesIO()
+        with zipfile.ZipFile(buffer, 'w') as zf:
+            zf.writestr('id', os.urandom(16).hex())
+            zf.writestr('name', 'test')
+            zf.writestr('key', os.urandom(32))
+        key_path = os.path.join(self.dir, 'test.key')
+        with open(key_path, 'wb') as f:
+            f.write(buffer.getvalue())
+        os.chmod(key_path, 0o600)
+
+        self.assertTrue(migrate_key_file(key_path))
+        self.assertEqual(get_key_file_version(key_path), KEY_FORMAT_V2)
+        self.assertEqual(_mode(key_path), 0o600)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+
+from keymanager.encfile import open_encrypted
+
+
+class _Failure(Exception):
+    pass
+
+
+class EncryptedFileWriteTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._tmp.name, 'data.enc')
+        self.key = os.urandom(32)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def test_close_commits(self):
+        data = os.urandom(100000)
+        with open_encrypted(self.path, 'wb', self.key, chunk_size=4096) as f:
+            f.write(data)
+        with open_encrypted(self.path, 'rb', self.key) as f:
+            self.assertEqual(f.read(), data)
+
+    def test_exception_discards(self):
+        for mode, data in (('wb', b'x' * 10000), ('wt', 'x' * 10000)):
+            for buffering in ((-1, 0) if mode == 'wb' else (-1,)):
+                with self.assertRaises(_Failure):
+                    with open_encrypted(self.path, mode, self.key, buffering=buffering, chunk_size=4096) as f:
+                        f.write(data)
+                        raise _Failure()
+                self.assertEqual(os.listdir(self._tmp.name), [])
+
+    def test_exception_keeps_existing_file(self):
+        with open_encrypted(self.path, 'wb', self.key) as f:
+            f.write(b'old')
+        with self.assertRaises(_Failure):
+            with open_encrypted(self.path, 'wb', self.key) as f:
+                f.write(b'new' * 10000)
+                raise _Failure()
+        with open_encrypted(self.path, 'rb', self.key) as f:
+            self.assertEqual(f.read(), b'old')
+        self.assertEqual(os.listdir(self._tmp.name), ['data.enc'])
+
+    def test_abort(self):
+        f = open_encrypted(self.path, 'w', self.key, encoding='utf-8')
+        f.write('text')
+        f.abort()
+        self.assertTrue(f.closed)
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
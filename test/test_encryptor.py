@@ -0,0 +1,49 @@
+import os
+import tempfile
+import unittest
+
+from keymanager.encryptor import BufferPool, encrypt_file, decrypt_file_pooled, encrypt_stream, \
+    FORMAT_V1, FORMAT_V2, FORMAT_V3, COMPRESS_NONE, COMPRESS_ZLIB
+
+
+class PooledDecryptTest(unittest.TestCase):
+
+    def setUp(self):
+        self._tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self._tmp.name, 'src')
+        self.enc = os.path.join(self._tmp.name, 'enc')
+        self.dst = os.path.join(self._tmp.name, 'dst')
+        self.key = os.urandom(32)
+        self.pool = BufferPool()
+        # 容易压缩的数据，密文比明文小很多
+        self.data = b'keymanager' * 10000
+        with open(self.src, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        self._tmp.cleanup()
+
+    def assertRoundTrip(self):
+        self.assertEqual(decrypt_file_pooled(self.key, self.enc, self.dst, self.pool), len(self.data))
+        with open(self.dst, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_round_trip(self):
+        for version, compression in ((FORMAT_V1, COMPRESS_NONE), (FORMAT_V2, COMPRESS_NONE),
+                                     (FORMAT_V3, COMPRESS_NONE), (FORMAT_V2, COMPRESS_ZLIB),
+                                     (FORMAT_V3, COMPRESS_ZLIB)):
+            with self.subTest(version=version, compression=compression):
+                encrypt_file(self.key, self.src, self.enc, chunk_size=4096, version=version, compression=compression)
+                if compression != COMPRESS_NONE:
+                    self.assertLess(os.path.getsize(self.enc), len(self.data))
+                self.assertRoundTrip()
+
+    def test_framed(self):
+        with open(self.src, 'rb') as src, open(self.enc, 'wb') as dst:
+            encrypt_stream(self.key, src, dst, chunk_size=4096, version=FORMAT_V3, compression=COMPRESS_ZLIB,
+                           framed=True)
+        self.assertRoundTrip()
+
+
+if __name__ == '__main__':
+    unittest.main()
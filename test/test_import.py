@@ -0,0 +1,55 @@
+import os
+import subprocess
+import sys
+import textwrap
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QT_MODULES = ('PySide6', 'qtawesome')
+
+# 在子进程中导入，不受当前进程已经加载的模块影响。
+# 被禁止的包即使已经安装也无法导入，导入时出错或者导入后出现在sys.modules中都算失败
+_SCRIPT = textwrap.dedent('''
+    import importlib
+    import sys
+
+    class _Blocker:
+        def find_spec(self, name, path=None, target=None):
+            if name.split('.')[0] in {blocked!r}:
+                raise ImportError('禁止导入' + name)
+            return None
+
+    sys.meta_path.insert(0, _Blocker())
+    for module_name in {modules!r}:
+        importlib.import_module(module_name)
+    package = importlib.import_module('keymanager')
+    for attr in {attrs!r}:
+        getattr(package, attr)
+    loaded = sorted(name for name in sys.modules if name.split('.')[0] in {blocked!r})
+    if loaded:
+        raise SystemExit('导入了' + ', '.join(loaded))
+''')
+
+
+class ImportTest(unittest.TestCase):
+
+    def assertNotImported(self, blocked, modules=(), attrs=()):
+        script = _SCRIPT.format(blocked=set(blocked), modules=list(modules), attrs=list(attrs))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, env.get('PYTHONPATH')]))
+        proc = subprocess.run([sys.executable, '-c', script], cwd=ROOT, env=env,
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(proc.returncode, 0, proc.stderr)
+
+    def test_package_without_qt_and_crypto(self):
+        self.assertNotImported(QT_MODULES + ('Crypto',), ['keymanager'])
+
+    def test_core_modules_without_qt(self):
+        self.assertNotImported(QT_MODULES, ['keymanager.key', 'keymanager.encryptor', 'keymanager.cli'])
+
+    def test_lazy_core_attrs_without_qt(self):
+        self.assertNotImported(QT_MODULES, attrs=['Key', 'KEY_CACHE', 'encrypt_data', 'decrypt_file'])
+
+
+if __name__ == '__main__':
+    unittest.main()